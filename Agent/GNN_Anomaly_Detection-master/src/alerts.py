@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import sqlite3
+import threading
+from queue import Queue, Empty
+from weakref import WeakKeyDictionary
+
+from instrumentation import recorder
+from config import alert_sink, alert_path, alert_batch_size, alert_flush_interval, alert_queue_size
+from config import alert_max_bytes, alert_backups, alert_suppression_window
+
+# Alerts of the detectors as compact fixed-schema records instead of printed node dicts.
+# The verdicts of all the detectors on a node are merged into one alert per batch (with every
+# reason and its score), and a node already reported within the last alert_suppression_window
+# batches is only reported again when it has a new reason. The alerts are put on a queue and a
+# background thread writes them to the sink in batches (alert_batch_size records, or what
+# arrived within alert_flush_interval seconds).
+
+ALERT_FIELDS = ['time', 'batch', 'node', 'side', 'ip', 'port', 'detectors', 'reasons', 'scores', 'cluster', 'flows', 'label', 'suppressed']
+
+# Default path of every sink
+ALERT_PATHS = {'jsonl': 'alerts.jsonl', 'sqlite': 'alerts.db', 'socket': '/tmp/gnn_anomaly_alerts.sock'}
+
+FLUSH = object()
+END = object()
+
+# `alert` holds the merged verdicts of the node, `suppressed` the batches it was not reported since its last alert
+def alert_record(graph, node_id, batch, alert, suppressed=0):
+    node = graph.nodes[node_id]
+    return {
+        'time': time.time(),
+        'batch': batch,
+        'node': node_id,
+        'side': node['side'],
+        'ip': node['ip'],
+        'port': node.get('port'),
+        'detectors': alert['detectors'],
+        'reasons': alert['reasons'],
+        'scores': alert['scores'],
+        'cluster': alert['cluster'],
+        'flows': node['flows'],
+        'label': bool(node['label']),
+        'suppressed': suppressed,
+    }
+
+def record_lines(records):
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+class StdoutSink():
+    def write(self, records):
+        sys.stdout.write(record_lines(records))
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+# JSON lines file, rotated to path.1 ... path.<backups> when it grows over max_bytes
+class JsonlSink():
+    def __init__(self, path, max_bytes=alert_max_bytes, backups=alert_backups) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def write(self, records):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(record_lines(records))
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# SQLite table `alerts` with one column per field, the lists and scores as JSON (the connection belongs to the writer thread)
+class SqliteSink():
+    def __init__(self, path) -> None:
+        self.path = path
+        self.connection = None
+
+    def write(self, records):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS alerts ({", ".join(ALERT_FIELDS)})')
+        with self.connection:
+            self.connection.executemany(f'INSERT INTO alerts VALUES ({", ".join("?" * len(ALERT_FIELDS))})',
+                                        [[json.dumps(record[field]) if isinstance(record[field], (list, dict)) else record[field]
+                                          for field in ALERT_FIELDS] for record in records])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+# JSON lines sent to a local listener: a Unix socket path or host:port
+class SocketSink():
+    def __init__(self, address) -> None:
+        self.address = address
+        self.socket = None
+
+    def connect(self):
+        host, _, port = self.address.rpartition(':')
+        if port.isdecimal():
+            return socket.create_connection((host or 'localhost', int(port)))
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_socket.connect(self.address)
+        return unix_socket
+
+    def write(self, records):
+        if self.socket is None:
+            self.socket = self.connect()
+        try:
+            self.socket.sendall(record_lines(records).encode())
+        except OSError:
+            # Reconnect with the next batch
+            self.close()
+            raise
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+def create_sink(kind, path=None):
+    path = path or ALERT_PATHS.get(kind)
+    if kind == 'stdout':
+        return StdoutSink()
+    if kind == 'jsonl':
+        return JsonlSink(path)
+    if kind == 'sqlite':
+        return SqliteSink(path)
+    if kind == 'socket':
+        return SocketSink(path)
+    raise ValueError(f'unknown alert sink: {kind}')
+
+# Collects the alerts of the detectors and writes them on a background thread.
+# The writer starts with the first alert; the sink is None when the alerts are only counted.
+class AlertWriter():
+    def __init__(self, kind=alert_sink, path=alert_path, batch_size=alert_batch_size, flush_interval=alert_flush_interval,
+                 queue_size=alert_queue_size, suppression_window=alert_suppression_window) -> None:
+        self.sink = create_sink(kind, path) if kind is not None else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.suppression_window = suppression_window
+        self.buffer = Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batch = 0 # detection batch of the alerts
+        # Per graph (dropped with the graph): node -> merged verdicts of the current batch
+        self.verdicts = WeakKeyDictionary()
+        # Per graph: node -> [batch of the last alert, reasons reported since, batches suppressed since],
+        # only the nodes whose last alert is within the suppression window
+        self.reported = WeakKeyDictionary()
+        atexit.register(self.close)
+
+    # Add the verdict of a detector, the verdicts are reported at the end of the batch
+    def emit(self, graph, node_id, detector, reason, score=None, cluster=None):
+        recorder.count('verdicts')
+        verdicts = self.verdicts.setdefault(graph, {})
+        alert = verdicts.get(node_id)
+        if alert is None:
+            alert = verdicts[node_id] = {'detectors': [], 'reasons': [], 'scores': {}, 'cluster': None}
+        if detector not in alert['detectors']:
+            alert['detectors'].append(detector)
+        if reason not in alert['reasons']:
+            alert['reasons'].append(reason)
+        if score is not None:
+            alert['scores'][reason] = max(float(score), alert['scores'].get(reason, float('-inf')))
+        if cluster is not None:
+            alert['cluster'] = int(cluster)
+
+    # One alert per node with verdicts, unless it is a repeat within the suppression window
+    def report(self):
+        verdicts, self.verdicts = self.verdicts, WeakKeyDictionary()
+        records = []
+        num_verdicts = 0
+        for graph, graph_verdicts in list(verdicts.items()):
+            graph_reported = self.reported.setdefault(graph, {})
+            num_verdicts += len(graph_verdicts)
+            for node_id, alert in graph_verdicts.items():
+                reasons = set(alert['reasons'])
+                reported = graph_reported.get(node_id)
+                if reported is not None and self.batch - reported[0] < self.suppression_window:
+                    if reasons <= reported[1]:
+                        reported[2] += 1
+                        continue
+                    reasons |= reported[1]
+                records.append(alert_record(graph, node_id, self.batch, alert, reported[2] if reported is not None else 0))
+                graph_reported[node_id] = [self.batch, reasons, 0]
+
+        recorder.count('alerts_reported', len(records))
+        recorder.count('alerts_suppressed', num_verdicts - len(records))
+        if self.sink is None or not records:
+            return
+        self.start()
+        for record in records:
+            self.buffer.put(record)
+
+    def end_batch(self):
+        self.report()
+        self.batch += 1
+        self.evict()
+
+    # Forget the nodes whose last alert left the suppression window, they can no longer suppress anything
+    def evict(self):
+        for graph, graph_reported in list(self.reported.items()):
+            expired = [node_id for node_id, reported in graph_reported.items() if self.batch - reported[0] >= self.suppression_window]
+            for node_id in expired:
+                del graph_reported[node_id]
+            if not graph_reported:
+                del self.reported[graph]
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_alerts, daemon=True)
+                self.thread.start()
+
+    # Write the records in batches until END
+    def write_alerts(self):
+        while True:
+            record = self.buffer.get()
+            records, items = [], [record]
+            deadline = time.monotonic() + self.flush_interval
+            # Gather a batch, a marker writes what was gathered right away
+            while record is not FLUSH and record is not END:
+                records.append(record)
+                if len(records) >= self.batch_size:
+                    break
+                try:
+                    record = self.buffer.get(timeout=max(deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+                items.append(record)
+
+            if records:
+                try:
+                    self.sink.write(records)
+                except (OSError, sqlite3.Error) as error:
+                    print(f'failed to write {len(records)} alerts: {error}', file=sys.stderr)
+                    recorder.count('alerts_dropped', len(records))
+            for _ in items:
+                self.buffer.task_done()
+            if items[-1] is END:
+                self.sink.close()
+                return
+
+    # Wait until the alerts emitted so far are written
+    def flush(self):
+        self.report()
+        if self.thread is not None:
+            self.buffer.put(FLUSH)
+            self.buffer.join()
+
+    def close(self):
+        self.report()
+        with self.lock:
+            if self.thread is None:
+                return
+            self.buffer.put(END)
+            self.thread.join()
+            self.thread = None
+
+alert_writer = AlertWriter()
@@ -1,8 +1,19 @@
+import os
+import json
 import numpy as np
 from annoy import AnnoyIndex
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from config import features, ann_threshold, ann_history_threshold, anomaly_score_history_size, output_size
+from knn import exact_anomaly_scores
+from shared_ann import shared_index_path, query_shared_annoy, store_neighbors
+from instrumentation import recorder
+from alerts import alert_writer
+from verdicts import Verdicts
+from score_recording import score_recorder
+from config import features, ann_threshold, ann_history_threshold
+from config import ann_backend, exact_knn_max_nodes, ann_query_jobs, ann_query_chunk_size, ann_tuning_file
+from config import ann_shared_index_dir, ann_query_processes
 
 def node_to_str(node) -> str:
     print_str = ''
@@ -29,84 +40,166 @@ def node_to_str(node) -> str:
     
     return print_str
 
-def print_anomalies(graph, anomaly_node_id, description):
+def print_anomalies(graph, anomaly_node_id, description, score=None):
     anomaly_node = graph.nodes[anomaly_node_id]
     # anomaly_node_str = node_to_str(anomaly_node)
     # ts = datetime.fromtimestamp(anomaly_node["packet_index"]).strftime('%Y-%m-%d %H:%M:%S')
     # ts = datetime.fromtimestamp(int(anomaly_node["packet_index"])).strftime('%Y-%m-%d %H:%M:%S')
     # print(f'found ({description}) anomaly on packet number {ts} (node id: {anomaly_node_id}): {anomaly_node_str}')
-    print(f'found anomaly in node: {anomaly_node}')
+    # print(f'found anomaly in node: {anomaly_node}')
+    alert_writer.emit(graph, anomaly_node_id, 'ann', description, score)
 
-# Function to perform anomaly detection using an Approximate Nearest Neighbor (ANN) algorithm
-def ann_algorithm(graph, embeddings, to_print=True, algo='ann', pred=[], node_to_index={}):    
-    # Initialize an Annoy index for nearest neighbor search
-    dimension = output_size  # Number of features in the vectors
-    index = AnnoyIndex(dimension, 'euclidean')
+NUM_NEIGHBORS = 4  # Number of neighbors to find 
+N_TREES = 10  # Default number of trees for the index
+SEARCH_K = -1  # Default search_k, -1 means use n_trees * num_neighbors
+
+annoy_tuning = None
+
+# Graph-size bucket of the tuned Annoy parameters (next power of two)
+def size_bucket(num_nodes):
+    return int(2 ** np.ceil(np.log2(max(num_nodes, 1))))
+
+# Annoy parameters for a graph size, taken from the tuning file (see tune_ann.py) when it exists
+def annoy_parameters(num_nodes):
+    global annoy_tuning
+    if annoy_tuning is None:
+        annoy_tuning = {}
+        if ann_tuning_file and os.path.exists(ann_tuning_file):
+            with open(ann_tuning_file) as file:
+                annoy_tuning = {int(bucket): settings for bucket, settings in json.load(file).items()}
+
+    if not annoy_tuning:
+        return N_TREES, SEARCH_K
+
+    # Use the smallest tuned bucket that holds the graph, or the largest one
+    buckets = sorted(annoy_tuning)
+    bucket = next((bucket for bucket in buckets if bucket >= size_bucket(num_nodes)), buckets[-1])
+    return annoy_tuning[bucket]['n_trees'], annoy_tuning[bucket]['search_k']
+
+# Build an Annoy index over the embeddings, directly into a memory-mapped file when a path is given
+def build_annoy_index(embeddings, n_trees, path=None):
+    index = AnnoyIndex(embeddings.shape[1], 'euclidean')
+    if path is not None:
+        index.on_disk_build(path)
 
     # Add vectors to the index
     for i, embedding in enumerate(embeddings):
         index.add_item(i, embedding)
-
-    n_trees =  10  # Number of trees for the index
-    search_k = -1  # -1 means use n_trees * n_trees
-    num_neighbors = 4  # Number of neighbors to find 
     
     # Build the index
     index.build(n_trees)
+    return index
+
+# Number of threads used for neighbor queries (-1 means all cores)
+def query_jobs():
+    return os.cpu_count() if ann_query_jobs == -1 else ann_query_jobs
+
+# Query the neighbors of every item of a built Annoy index on a thread pool.
+# The index is read-only after build and Annoy releases the GIL while searching,
+# so every chunk writes its rows directly into the preallocated distance array
+# (rows with fewer neighbors than asked are padded, see store_neighbors).
+def query_annoy(index, num_items, num_neighbors, search_k=-1):
+    num_neighbors = min(num_neighbors, num_items)
+    distances = np.empty((num_items, num_neighbors))
+    neighbors = np.empty((num_items, num_neighbors), dtype=np.int64)
+
+    def query_chunk(start):
+        for i in range(start, min(start + ann_query_chunk_size, num_items)):
+            store_neighbors(neighbors, distances, i, index.get_nns_by_item(i, num_neighbors, include_distances=True, search_k=search_k))
+
+    chunks = range(0, num_items, ann_query_chunk_size)
+    jobs = query_jobs()
+    if jobs <= 1 or len(chunks) <= 1:
+        for start in chunks:
+            query_chunk(start)
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(query_chunk, chunks))
+
+    return distances, neighbors
+
+# Function to calculate the anomaly score (mean distance to the nearest neighbors) of every embedding with a fresh Annoy index
+def annoy_anomaly_scores(embeddings, num_neighbors=NUM_NEIGHBORS):
+    n_trees, search_k = annoy_parameters(embeddings.shape[0])
     
-    # Calculate distances to the nearest neighbors
-    distances = [index.get_nns_by_item(i, num_neighbors, include_distances=True, search_k=search_k)[1] for i in range(embeddings.shape[0])]
+    if ann_shared_index_dir is None:
+        with recorder.stage('annoy_build'):
+            index = build_annoy_index(embeddings, n_trees)
+        
+        # Calculate distances to the nearest neighbors
+        with recorder.stage('annoy_query'):
+            distances, _ = query_annoy(index, embeddings.shape[0], num_neighbors, search_k)
+    else:
+        # Build the index into a shared file, scoring processes mmap it instead of holding a copy
+        path = shared_index_path()
+        with recorder.stage('annoy_build'):
+            index = build_annoy_index(embeddings, n_trees, path)
+        try:
+            with recorder.stage('annoy_query'):
+                if ann_query_processes > 0:
+                    distances, _ = query_shared_annoy(path, embeddings.shape[1], embeddings.shape[0], num_neighbors, search_k)
+                else:
+                    distances, _ = query_annoy(index, embeddings.shape[0], num_neighbors, search_k)
+        finally:
+            index.unload()
+            os.remove(path)
     
-    # Calculate anomaly scores
-    anomaly_scores = np.mean(distances, axis=1)
+    # Calculate anomaly scores (over the neighbors found)
+    return np.nanmean(distances, axis=1)
+
+# Choose between exact and approximate nearest neighbors by the size of the graph
+def select_ann_backend(num_nodes):
+    if ann_backend == 'auto':
+        return 'exact' if num_nodes <= exact_knn_max_nodes else 'annoy'
+    return ann_backend
+
+# Anomaly score of every embedding, computed without touching the graph (safe to run concurrently)
+def ann_anomaly_scores(embeddings, nn_index=None, knn=None):
+    with recorder.stage('ann_scores'):
+        # Use the persistent index when one lives across batches, otherwise score the batch from scratch
+        backend = select_ann_backend(embeddings.shape[0])
+        if nn_index is not None:
+            return nn_index.anomaly_scores_of(embeddings)
+        elif backend == 'exact' and knn is not None:
+            # Reuse the exact kNN (self excluded) computed for clustering, the node itself counts as a 0 distance
+            return np.sum(knn[0][:, :NUM_NEIGHBORS - 1], axis=1) / NUM_NEIGHBORS
+        elif backend == 'exact':
+            return exact_anomaly_scores(embeddings, NUM_NEIGHBORS)
+        else:
+            return annoy_anomaly_scores(embeddings)
+
+# Function to perform anomaly detection using an Approximate Nearest Neighbor (ANN) algorithm
+def ann_algorithm(graph, embeddings, to_print=True, algo='ann', pred=[], node_to_index={}, nn_index=None, knn=None, anomaly_scores=None, verdicts=None):
+    if anomaly_scores is None:
+        anomaly_scores = ann_anomaly_scores(embeddings, nn_index, knn)
+    if verdicts is None:
+        verdicts = Verdicts.of_graph(graph)
+    before = verdicts.snapshot()
     
     avg_distance = np.mean(anomaly_scores)
     std_distance = np.std(anomaly_scores)
+    score_recorder.set('ann_scores', anomaly_scores)
+    score_recorder.set('ann_mean', avg_distance)
+    score_recorder.set('ann_std', std_distance)
+    
+    # Nodes far from their neighbors in this batch, and nodes far above their own score history
+    flagged = anomaly_scores > avg_distance + ann_threshold * std_distance
+    verdicts.raise_score(anomaly_scores, avg_distance, ann_threshold * std_distance)
+    history_flagged = verdicts.add_scores(anomaly_scores, ann_history_threshold)
+    detected = flagged | history_flagged
     
-    anomalies = [i for i in range(len(anomaly_scores)) 
-                        if (anomaly_scores[i] > avg_distance + ann_threshold * std_distance) ]
+    verdicts.ann_pred |= detected
+    confirmed = verdicts.confirmed(detected) if algo == 'combined' else detected
+    verdicts.pred |= confirmed
     
-    # Print the anomalies nodes
+    # Report the anomalies nodes
     list_nodes = list(graph.nodes)
-    for anomaly in anomalies:
-        anomaly_node_id = list_nodes[anomaly]
-        if to_print:
-            print_anomalies(graph, anomaly_node_id, "ann")
-        graph.nodes[anomaly_node_id]["pred"] = True
-        graph.nodes[anomaly_node_id]["ann_pred"] = True
-        
-        if algo == 'combined':
-            graph.nodes[anomaly_node_id]["pred"] = graph.nodes[anomaly_node_id]["cluster_pred"] or graph.nodes[anomaly_node_id]["cluster"] == -1
-            if graph.nodes[anomaly_node_id]["pred"]:
-                print_anomalies(graph, anomaly_node_id, "ann")
-       
-        pred[node_to_index[anomaly_node_id]] = graph.nodes[anomaly_node_id]["pred"]
-            
-    # add the anomaly score to the history queue + check anomalies nodes
-    for i, anomaly_score in enumerate(anomaly_scores):
-        node_id = list_nodes[i]
-        queue = graph.nodes[node_id]["anomaly_score_history"]
-        
-        if len(queue) == anomaly_score_history_size:
-            avg_distance = np.mean(queue)
-            std_distance = np.std(queue)
-        
-            if anomaly_score > avg_distance + ann_history_threshold * std_distance:
-                if to_print:
-                    print_anomalies(graph, node_id, "history")
-                graph.nodes[node_id]["pred"] = True
-                graph.nodes[node_id]["ann_pred"] = True
-                
-                if algo == 'combined':
-                    graph.nodes[node_id]["pred"] = graph.nodes[node_id]["cluster_pred"] or graph.nodes[node_id]["cluster"] == -1
-                    if graph.nodes[node_id]["pred"]:
-                        print_anomalies(graph, node_id, "ann")
-                    
-                
-                             
-        if len(queue) >= anomaly_score_history_size:
-            queue.pop(0)  # Remove the first element
-        queue.append(anomaly_score)
+    if to_print:
+        for description, indices in [('ann', np.flatnonzero(flagged)), ('history', np.flatnonzero(history_flagged))]:
+            for i in indices:
+                print_anomalies(graph, list_nodes[i], description, anomaly_scores[i])
+                if algo == 'combined' and confirmed[i]:
+                    print_anomalies(graph, list_nodes[i], "combined", anomaly_scores[i])
     
-                
-    return anomalies
+    verdicts.write_back(graph, before, pred, node_to_index, list_nodes)
+    return np.flatnonzero(flagged)
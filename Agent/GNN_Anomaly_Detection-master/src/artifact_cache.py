@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from instrumentation import recorder
+from config import artifact_cache_dir, features, hidden_size, output_size, dataset_type, attacker_ip, victom_ip
+from config import clustering_mode, min_cluster_size, clustering_algorithm_type, clustering_leaf_size, clustering_core_dist_n_jobs
+from config import clustering_gen_min_span_tree, clustering_knn_graph, clustering_knn_neighbors, clustering_sample_threshold, clustering_sample_size
+
+# Content-addressed cache of the per-batch artifacts (embeddings, cluster labels) for replaying
+# the same input with other detection settings. The graph of a batch is a function of the input
+# file and of the number of flows applied to it so far, and the GCN (fixed seed) and HDBSCAN are
+# deterministic, so an artifact is keyed by the input digest, the flow count and every setting it
+# depends on. Artifacts are .npy files in artifact_cache_dir/<key>/, loaded memory-mapped.
+# A cache belongs to one pipeline run (TriGraph.artifact_cache), the readers open it for their
+# input; nothing is cached when artifact_cache_dir is None or the input is not a file (live mode).
+
+# Bump when the graph, embedding or clustering code changes the artifacts of the same settings
+ARTIFACT_VERSION = 1
+
+# Every setting the graph and its embeddings depend on
+EMBEDDING_SETTINGS = {
+    'features': features, 'hidden_size': hidden_size, 'output_size': output_size,
+    'dataset_type': dataset_type, 'attacker_ip': attacker_ip, 'victom_ip': victom_ip,
+}
+# And the cluster labels
+CLUSTERING_SETTINGS = {
+    'clustering_mode': clustering_mode, 'min_cluster_size': min_cluster_size, 'clustering_algorithm_type': clustering_algorithm_type,
+    'clustering_leaf_size': clustering_leaf_size, 'clustering_core_dist_n_jobs': clustering_core_dist_n_jobs,
+    'clustering_gen_min_span_tree': clustering_gen_min_span_tree, 'clustering_knn_graph': clustering_knn_graph,
+    'clustering_knn_neighbors': clustering_knn_neighbors, 'clustering_sample_threshold': clustering_sample_threshold,
+    'clustering_sample_size': clustering_sample_size,
+}
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ArtifactCache():
+    # `input` describes the input file and how it is turned into flows
+    def __init__(self, path, input) -> None:
+        self.path = path
+        self.input = input
+
+    # Key of an artifact of the current graph
+    def key(self, tri_graph, name):
+        settings = CLUSTERING_SETTINGS if name == 'clusters' else {}
+        description = {'version': ARTIFACT_VERSION, 'input': self.input, 'flows': tri_graph.count_flows,
+                       'nodes': tri_graph.graph.number_of_nodes(), 'edges': tri_graph.graph.number_of_edges(),
+                       'artifact': name, **EMBEDDING_SETTINGS, **settings}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def file(self, key, name):
+        return os.path.join(self.path, key[:2], key, f'{name}.npy')
+
+    # The cached artifact (memory-mapped, read-only), None when it was not computed before
+    def load(self, key, name):
+        try:
+            array = np.load(self.file(key, name), mmap_mode='r')
+        except (OSError, ValueError):
+            recorder.count(f'{name}_cache_misses')
+            return None
+        recorder.count(f'{name}_cache_hits')
+        return array
+
+    def store(self, key, name, array):
+        path = self.file(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write a temporary file and rename it, so a reader never sees a partial artifact
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            np.save(file, np.asarray(array))
+        os.replace(temporary, path)
+
+# Cache of a run on an input file, `reader` describes how the file is turned into flows.
+# None when nothing is cached.
+def open_artifact_cache(input_file_path, **reader):
+    if artifact_cache_dir is None or input_file_path is None or not os.path.isfile(input_file_path):
+        return None
+    return ArtifactCache(artifact_cache_dir, {'digest': file_digest(input_file_path), **reader})
@@ -0,0 +1,161 @@
+import os
+import sys
+import csv
+import json
+import time
+import numpy as np
+from contextlib import redirect_stdout
+
+from tri_graph import TriGraph
+from ann import annoy_anomaly_scores, NUM_NEIGHBORS
+from knn import exact_anomaly_scores, exact_knn
+from clustering import create_clusterer, cluster_knn_graph, knn_distance_graph, sampled_clustering_algorithm, flagged_nodes
+from synthetic import generate_dataset
+from csv_reading import process_flows
+from flow_separation_csv import separate_packets_csv
+from instrumentation import recorder
+from sklearn.metrics import adjusted_rand_score
+from config import feature_to_name, ann_threshold, clustering_knn_neighbors
+
+# Build the tri-graph from a flows csv batch by batch (like process_flows) and yield the embeddings of every batch
+def collect_embeddings(input_file_path, num_of_flows, dic_feature_to_name=feature_to_name, num_of_rows=-1):
+    tri_graph = TriGraph()
+    pred, label, node_to_index = [], [], {}
+
+    with open(input_file_path, mode='r') as file:
+        for i, row in enumerate(csv.DictReader(file)):
+            if i == num_of_rows:
+                break
+            if row[dic_feature_to_name['Protocol']] != dic_feature_to_name['TCP']:
+                continue
+
+            tri_graph.add_flow_to_graph(row, pred, label, node_to_index, dic_feature_to_name)
+
+            if i and i % num_of_flows == 0:
+                yield tri_graph, tri_graph.create_embeddings().detach().numpy()
+
+    yield tri_graph, tri_graph.create_embeddings().detach().numpy()
+
+# Measure the run time of a function, returns the result and the time in milliseconds
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+# Flag the scores the same way ann_algorithm does
+def flag_anomalies(anomaly_scores):
+    return anomaly_scores > np.mean(anomaly_scores) + ann_threshold * np.std(anomaly_scores)
+
+# Compare the current Annoy path with the exact blocked kNN scorer on every batch
+def benchmark_knn(input_file_path, num_of_flows):
+    print('batch, nodes, annoy_ms, exact_ms, mean_score_error, flags_annoy, flags_exact, flags_agree')
+    for batch, (_, embeddings) in enumerate(collect_embeddings(input_file_path, num_of_flows)):
+        annoy_scores, annoy_ms = timed(annoy_anomaly_scores, embeddings, NUM_NEIGHBORS)
+        exact_scores, exact_ms = timed(exact_anomaly_scores, embeddings, NUM_NEIGHBORS)
+
+        annoy_flags, exact_flags = flag_anomalies(annoy_scores), flag_anomalies(exact_scores)
+        score_error = np.mean(np.abs(annoy_scores - exact_scores))
+        print(f'{batch}, {len(embeddings)}, {annoy_ms:.1f}, {exact_ms:.1f}, {score_error:.4f}, '
+              f'{annoy_flags.sum()}, {exact_flags.sum()}, {np.mean(annoy_flags == exact_flags):.4f}')
+
+CLUSTERING_SETTINGS = {
+    'previous (best, gen_min_span_tree)': {'algorithm': 'best', 'core_dist_n_jobs': 4, 'gen_min_span_tree': True},
+    'best': {'algorithm': 'best', 'core_dist_n_jobs': 1},
+    'boruvka_kdtree': {'algorithm': 'boruvka_kdtree', 'core_dist_n_jobs': 1},
+    'boruvka_kdtree, all cores': {'algorithm': 'boruvka_kdtree', 'core_dist_n_jobs': -1},
+    'boruvka_balltree': {'algorithm': 'boruvka_balltree', 'core_dist_n_jobs': 1},
+    'boruvka_balltree, all cores': {'algorithm': 'boruvka_balltree', 'core_dist_n_jobs': -1},
+    'prims_kdtree': {'algorithm': 'prims_kdtree'},
+    'prims_balltree': {'algorithm': 'prims_balltree'},
+    'boruvka_kdtree, leaf_size 100': {'algorithm': 'boruvka_kdtree', 'core_dist_n_jobs': -1, 'leaf_size': 100},
+}
+
+# Latency of every HDBSCAN setting (and of the precomputed kNN graph) on the embeddings of every batch
+def benchmark_clustering(input_file_path, num_of_flows):
+    print(f'batch, nodes, setting, ms, clusters')
+    for batch, (_, embeddings) in enumerate(collect_embeddings(input_file_path, num_of_flows)):
+        for name, settings in CLUSTERING_SETTINGS.items():
+            labels, ms = timed(create_clusterer(**settings).fit_predict, embeddings)
+            print(f'{batch}, {len(embeddings)}, {name}, {ms:.1f}, {labels.max() + 1}')
+
+        knn, knn_ms = timed(exact_knn, embeddings, clustering_knn_neighbors, True)
+        labels, ms = timed(cluster_knn_graph, knn_distance_graph(knn))
+        print(f'{batch}, {len(embeddings)}, precomputed kNN graph (kNN {knn_ms:.1f} ms), {knn_ms + ms:.1f}, {labels.max() + 1}')
+
+SAMPLE_FRACTIONS = [0.1, 0.25, 0.5]
+
+# Quality/speed of clustering a stratified sample and assigning the rest, against full HDBSCAN
+def benchmark_sampling(input_file_path, num_of_flows):
+    print('batch, nodes, sample, ms, adjusted_rand_index, flagged_nodes, flagged_jaccard')
+    for batch, (tri_graph, embeddings) in enumerate(collect_embeddings(input_file_path, num_of_flows)):
+        sides = [side for _, side in tri_graph.graph.nodes(data='side')]
+        full_labels, full_ms = timed(create_clusterer().fit_predict, embeddings)
+        full_flagged = set(flagged_nodes(embeddings, full_labels))
+        print(f'{batch}, {len(embeddings)}, full, {full_ms:.1f}, 1.0000, {len(full_flagged)}, 1.0000')
+
+        for fraction in SAMPLE_FRACTIONS:
+            labels, ms = timed(sampled_clustering_algorithm, embeddings, sides, int(fraction * len(embeddings)))
+            flagged = set(flagged_nodes(embeddings, labels))
+            jaccard = len(flagged & full_flagged) / len(flagged | full_flagged) if flagged | full_flagged else 1.0
+            print(f'{batch}, {len(embeddings)}, {fraction}, {ms:.1f}, {adjusted_rand_score(full_labels, labels):.4f}, {len(flagged)}, {jaccard:.4f}')
+
+SCALING_SIZES = [10000, 100000, 1000000, 10000000]
+SCALING_STAGES = ['parse', 'graph_update', 'features', 'gcn_forward', 'hdbscan', 'cluster_statistics', 'ann_scores', 'alerts']
+# Schemas the pipeline parses with the configured feature_to_name (the IoT and Elasticsearch flows need their own dataset_type)
+SCALING_SCHEMAS = ['cic2017', 'packets']
+
+# Throughput and per-stage latency of the whole pipeline on synthetic datasets of growing size.
+# The datasets are generated once into data_dir (flows in the CIC-IDS-2017 schema, or tshark packets).
+def benchmark_scaling(data_dir, num_of_flows, sizes=None, schema='cic2017'):
+    if schema not in SCALING_SCHEMAS:
+        raise ValueError(f'unsupported scaling schema: {schema} (one of {", ".join(SCALING_SCHEMAS)})')
+    sizes = SCALING_SIZES if sizes is None else [int(size) for size in sizes.split(',')]
+    print(f'flows, nodes, edges, batches, seconds, flows_per_second, max_batch_ms, peak_rss_mb, '
+          f'{", ".join(f"{stage}_ms" for stage in SCALING_STAGES)}')
+    for size in sizes:
+        path = os.path.join(data_dir, f'synthetic_{schema}_{size}.csv')
+        if not os.path.exists(path):
+            generate_dataset(path, size, schema)
+
+        stats_path = f'{path}.stats.jsonl'
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+        recorder.path = stats_path
+
+        # The alerts are not part of the measurement output
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            if schema == 'packets':
+                separate_packets_csv(path, algo='combined', plot=False, num_of_flows=num_of_flows)
+            else:
+                process_flows(feature_to_name, path, num_of_flows, algo='combined')
+        seconds = time.perf_counter() - start
+        recorder.path = None
+
+        with open(stats_path) as file:
+            records = [json.loads(line) for line in file]
+        stages = {stage: sum(record['stages_ms'].get(stage, 0.0) for record in records) for stage in SCALING_STAGES}
+        print(f'{size}, {records[-1]["nodes"]}, {records[-1]["edges"]}, {len(records)}, {seconds:.1f}, {size / seconds:.0f}, '
+              f'{max(record["batch_ms"] for record in records):.1f}, {max(record["peak_rss_mb"] for record in records):.1f}, '
+              f'{", ".join(f"{stages[stage]:.1f}" for stage in SCALING_STAGES)}', flush=True)
+
+benchmarks = {
+    'knn': benchmark_knn,
+    'clustering': benchmark_clustering,
+    'sampling': benchmark_sampling,
+    'scaling': benchmark_scaling,
+}
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3 or sys.argv[1] not in benchmarks:
+        print(f'usage: benchmark.py [{"|".join(benchmarks)}] input_file_path num_of_flows')
+        print('       benchmark.py scaling data_dir num_of_flows [sizes, e.g. 10000,100000] [cic2017|packets]')
+        exit(1)
+
+    if len(sys.argv) < 4 or not sys.argv[3].isdecimal():
+        num_of_flows = 2000
+    else:
+        num_of_flows = int(sys.argv[3])
+
+    benchmarks[sys.argv[1]](sys.argv[2], num_of_flows, *sys.argv[4:])
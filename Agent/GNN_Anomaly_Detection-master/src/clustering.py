@@ -2,104 +2,293 @@ import numpy as np
 
 # For clustering
 import hdbscan
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 # For anomalies
-from sklearn.metrics import pairwise_distances_argmin_min
+from knn import exact_knn
+from alerts import alert_writer
+from verdicts import Verdicts
+from score_recording import score_recorder
 
-from config import clustering_threshold, dataset_type
+from config import clustering_threshold
+from config import clustering_refit_interval, clustering_max_drift, clustering_update_tolerance
+from config import min_cluster_size, clustering_algorithm_type, clustering_core_dist_n_jobs, clustering_leaf_size
+from config import clustering_gen_min_span_tree, clustering_knn_graph, clustering_knn_neighbors
+from config import clustering_sample_threshold, clustering_sample_size
+
+# Initialize HDBSCAN, the arguments override the configured settings
+def create_clusterer(prediction_data=False, **settings):
+    settings = {
+        'min_cluster_size': min_cluster_size,
+        'algorithm': clustering_algorithm_type,
+        'core_dist_n_jobs': clustering_core_dist_n_jobs,
+        'leaf_size': clustering_leaf_size,
+        'gen_min_span_tree': clustering_gen_min_span_tree,
+        'metric': 'euclidean',
+        'prediction_data': prediction_data,
+        **settings,
+    }
+    return hdbscan.HDBSCAN(**settings)
+
+# Sparse, symmetric kNN distance graph for HDBSCAN with metric='precomputed'
+def knn_distance_graph(knn):
+    distances, indices = knn
+    num_vectors = distances.shape[0]
+    # A zero in a sparse matrix is a missing edge, keep duplicate vectors connected
+    distances = np.maximum(distances, np.finfo(np.float64).tiny)
+    rows = np.repeat(np.arange(num_vectors), distances.shape[1])
+    graph = csr_matrix((distances.ravel(), (rows, indices.ravel())), shape=(num_vectors, num_vectors))
+    return graph.maximum(graph.T)
+
+# HDBSCAN on a sparse distance graph. HDBSCAN needs a connected graph, so every connected
+# component is clustered on its own; components too small to hold a cluster are noise.
+def cluster_knn_graph(graph):
+    num_components, components = connected_components(graph, directed=False)
+    labels = np.full(graph.shape[0], -1)
+    next_label = 0
+    groups = group_by_cluster(components)
+    for component in range(num_components):
+        members = cluster_members(groups, component)
+        if len(members) <= min_cluster_size:
+            continue
+        # The tree-based algorithms need coordinates, only 'generic' takes a precomputed graph
+        component_labels = create_clusterer(metric='precomputed', algorithm='generic').fit_predict(graph[members][:, members])
+        component_labels[component_labels >= 0] += next_label
+        labels[members] = component_labels
+        next_label = max(next_label, component_labels.max() + 1)
+    return labels
 
 # Function to perform clustering algorithm
-def clustering_algorithm(embeddings): 
+def clustering_algorithm(embeddings, knn=None, sides=None): 
+    
+    # Very large graphs are clustered on a sample of the nodes
+    if sides is not None and len(embeddings) > clustering_sample_threshold:
+        return sampled_clustering_algorithm(embeddings, sides)
+    
+    # Cluster a precomputed kNN graph (reused from the neighbor search when given)
+    if clustering_knn_graph:
+        if knn is None:
+            knn = exact_knn(embeddings, clustering_knn_neighbors, exclude_self=True)
+        distances, indices = knn
+        return cluster_knn_graph(knn_distance_graph((distances[:, :clustering_knn_neighbors], indices[:, :clustering_knn_neighbors])))
     
     # Initialize HDBSCAN
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=5, gen_min_span_tree=True, metric='euclidean')
+    clusterer = create_clusterer()
     
     # Perform clustering
     cluster_labels = clusterer.fit_predict(embeddings)
     
     return cluster_labels
 
+# Stratified random sample of the node indices: every side (Client-IP / Client / Server)
+# keeps its share of the sample, and at least enough nodes to form a cluster
+def stratified_sample(sides, sample_size, seed=0):
+    rng = np.random.default_rng(seed)
+    groups = group_by_cluster(sides)
+    sample = []
+    for side in range(len(groups[0])):
+        members = cluster_members(groups, groups[0][side])
+        side_size = max(int(round(sample_size * len(members) / len(sides))), min(len(members), 2 * min_cluster_size))
+        sample.append(rng.choice(members, size=min(side_size, len(members)), replace=False))
+    return np.sort(np.concatenate(sample))
+
+# HDBSCAN on a stratified sample of the nodes, the other nodes are assigned with approximate_predict
+def sampled_clustering_algorithm(embeddings, sides, sample_size=clustering_sample_size):
+    sample = stratified_sample(np.asarray(sides), sample_size)
+    rest = np.setdiff1d(np.arange(len(embeddings)), sample, assume_unique=True)
+
+    clusterer = create_clusterer(prediction_data=True)
+    labels = np.full(len(embeddings), -1)
+    labels[sample] = clusterer.fit_predict(embeddings[sample])
+    if len(rest):
+        labels[rest], _ = hdbscan.approximate_predict(clusterer, embeddings[rest])
+    return labels
+
+# Clustering that lives across batches: HDBSCAN is refitted every clustering_refit_interval batches
+# or when more than clustering_max_drift of the nodes are new or moved since the last fit.
+# Between refits only the new and changed nodes are assigned, with approximate_predict.
+class OnlineClusterer():
+    def __init__(self) -> None:
+        self.clusterer = None
+        self.labels = np.empty(0, dtype=np.int64)
+        self.vectors = None
+        self.fit_vectors = None
+        self.batches_since_refit = 0
+
+    # Rows of the current embeddings that moved compared to previous ones (new rows not included)
+    def moved(self, embeddings, previous):
+        return ~np.all(np.isclose(embeddings[:len(previous)], previous, rtol=clustering_update_tolerance, atol=0), axis=1)
+
+    # Fraction of the nodes that are new or moved since the last fit
+    def drift(self, embeddings):
+        stale = len(embeddings) - len(self.fit_vectors) + np.count_nonzero(self.moved(embeddings, self.fit_vectors))
+        return stale / len(embeddings)
+
+    def refit(self, embeddings):
+        # Too few nodes to form a cluster (and for the prediction data): all noise, refit with the next batch
+        if len(embeddings) <= min_cluster_size:
+            self.clusterer = None
+            self.labels = np.full(len(embeddings), -1)
+        else:
+            self.clusterer = create_clusterer(prediction_data=True)
+            self.labels = self.clusterer.fit_predict(embeddings)
+        self.fit_vectors = embeddings.copy()
+        self.batches_since_refit = 0
+
+    # Cluster labels of the embeddings of the current batch
+    def labels_of(self, embeddings):
+        self.batches_since_refit += 1
+        if (self.clusterer is None or self.batches_since_refit >= clustering_refit_interval
+                or self.drift(embeddings) > clustering_max_drift):
+            self.refit(embeddings)
+        else:
+            # Assign only the new nodes and the nodes that moved since the previous batch
+            ids = np.concatenate([np.flatnonzero(self.moved(embeddings, self.vectors)), np.arange(len(self.vectors), len(embeddings))])
+            self.labels = np.concatenate([self.labels, np.full(len(embeddings) - len(self.labels), -1)])
+            if len(ids):
+                self.labels[ids], _ = hdbscan.approximate_predict(self.clusterer, embeddings[ids])
+
+        self.vectors = embeddings.copy()
+        return self.labels.copy()
+
+# Group the vectors by cluster label (labels sorted like np.unique):
+# returns the inverse index of every vector, the member count of every cluster,
+# and the vector indices sorted by cluster with the offset of every cluster in them
+def group_by_cluster(labels):
+    unique_labels, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return unique_labels, inverse, counts, order, offsets
+
 #Function to calculte the amount of every cluster
 def count_vectors_in_clusters(labels):
     unique_labels, counts = np.unique(labels, return_counts=True)
     cluster_counts = dict(zip(unique_labels, counts))
     return cluster_counts
 
+# Vector indices of the members of a cluster label (empty when the label has no members)
+def cluster_members(groups, cluster):
+    unique_labels, _, _, order, offsets = groups
+    position = np.searchsorted(unique_labels, cluster)
+    if position == len(unique_labels) or unique_labels[position] != cluster:
+        return order[:0]
+    return order[offsets[position]:offsets[position + 1]]
+
 # Function to measure distance of a cluster
-def find_centroids(vectors, labels):
-    # Calculate centroids for each cluster
-    centroids = []
-    for cluster in np.unique(labels):
-        cluster_points = vectors[labels == cluster]
-        centroid = np.mean(cluster_points, axis=0)
-        centroids.append(centroid)
-    
-    # Convert centroids to a NumPy array
-    return np.array(centroids)
+def find_centroids(vectors, labels, groups=None):
+    _, _, counts, order, offsets = groups if groups is not None else group_by_cluster(labels)
+    # Sum the members of every cluster in one pass over the vectors sorted by cluster
+    sums = np.add.reduceat(np.asarray(vectors, dtype=np.float64)[order], offsets[:-1], axis=0)
+    return sums / counts[:, None]
 
 def calculate_centroid_distances(centroids):
-    distances = []
-    for i in range(len(centroids)):
-        list_without_current = np.delete(centroids, i, axis=0)
-        current_distance = pairwise_distances_argmin_min(centroids, list_without_current, metric='euclidean')[1]
-        distances.append(current_distance[i])
-    return distances
-
-# Function to measure density of a cluster
-def calculate_density(vectors, labels):
-    densities = []
-    for cluster in np.unique(labels):
-        cluster_points = vectors[labels == cluster]
-        centroid = np.mean(cluster_points, axis=0)
-        distances = pairwise_distances_argmin_min(cluster_points, [centroid])[1]
-        current_density = np.mean(distances)
-        densities.append(current_density)
-    return densities
-
-
-def check_all_anomalies(graph, embeddings, clusters, pred, node_to_index, to_print=True):
+    # Distance of every centroid to the nearest other centroid
+    if len(centroids) < 2:
+        return np.zeros(len(centroids))
+    distances, _ = exact_knn(centroids, 1, exclude_self=True)
+    return distances[:, 0]
+
+# Function to measure density of a cluster (mean distance of the members to the centroid)
+def calculate_density(vectors, labels, centroids=None, groups=None):
+    groups = groups if groups is not None else group_by_cluster(labels)
+    _, inverse, counts, _, _ = groups
+    if centroids is None:
+        centroids = find_centroids(vectors, labels, groups)
+    distances = np.linalg.norm(np.asarray(vectors, dtype=np.float64) - centroids[inverse], axis=1)
+    return np.bincount(inverse, weights=distances, minlength=len(counts)) / counts
+
+# Amount, density and nearest-other-centroid distance of every cluster
+def cluster_statistics(vectors, labels, groups=None):
+    groups = groups if groups is not None else group_by_cluster(labels)
+    _, _, counts, _, _ = groups
+    centroids = find_centroids(vectors, labels, groups)
+    densities = calculate_density(vectors, labels, centroids, groups)
+    centroid_distances = calculate_centroid_distances(centroids)
+    return counts, densities, centroid_distances
+
+# Position of the first cluster in the groups, the isolated nodes (label -1) come first when there are any
+def first_cluster(unique_labels):
+    return int(len(unique_labels) > 0 and unique_labels[0] == -1)
+
+# Clusters whose statistic deviates from the mean by more than clustering_threshold standard deviations
+# (positions in `elements`, the statistic of the clusters without the isolated nodes)
+def unusual_clusters(elements):
+    elements = np.asarray(elements)
+    if len(elements) == 0:
+        return []
+    avg_elements = np.mean(elements)
+    std_elements = np.std(elements)
+    
+    return [i for i in range(len(elements)) 
+            if (elements[i] > avg_elements + clustering_threshold * std_elements) 
+            or  (elements[i] < avg_elements - clustering_threshold * std_elements)]
+
+# Deviation of every cluster's statistic from the mean in standard deviations (the alert score)
+def cluster_deviations(elements):
+    elements = np.asarray(elements, dtype=np.float64)
+    std_elements = np.std(elements) if len(elements) else 0
+    if std_elements == 0:
+        return np.zeros(len(elements))
+    return np.abs(elements - np.mean(elements)) / std_elements
+
+# Indices of the nodes in unusual clusters (by amount, density or distance between centroids)
+def flagged_nodes(embeddings, clusters):
+    groups, unusual = detect_cluster_anomalies(embeddings, clusters)
+    members = [cluster_members(groups, cluster) for _, unusual_elements, _ in unusual for cluster, _ in unusual_elements]
+    return np.unique(np.concatenate(members)) if members else np.empty(0, dtype=np.int64)
+
+# Unusual clusters of every statistic (label, deviation) and the deviations of all the clusters in label order
+# without the isolated nodes, computed without touching the graph (safe to run concurrently)
+def detect_cluster_anomalies(embeddings, clusters):
+    # Cluster -> member indices, built once per batch
+    groups = group_by_cluster(clusters)
+    unique_labels = groups[0]
+    first = first_cluster(unique_labels)
+    cluster_counts, cluster_densities, centroid_distances = cluster_statistics(embeddings, clusters, groups)
+    score_recorder.set('cluster_labels', clusters)
+    score_recorder.set('cluster_amount', cluster_counts)
+    score_recorder.set('cluster_density', cluster_densities)
+    score_recorder.set('cluster_distances', centroid_distances)
+    
+    unusual = []
+    for description, elements in [('amount', cluster_counts), ('density', cluster_densities), ('distances', centroid_distances)]:
+        deviations = cluster_deviations(elements[first:])
+        unusual.append((description, [(unique_labels[first + i], deviations[i]) for i in unusual_clusters(elements[first:])], deviations))
+    return groups, unusual
+
+def check_all_anomalies(graph, embeddings, clusters, pred, node_to_index, to_print=True, detections=None, verdicts=None):
     list_nodes = list(graph.nodes)
+    if verdicts is None:
+        verdicts = Verdicts.of_graph(graph)
+    before = verdicts.snapshot()
     
-    def check_and_print_anomalies(elements, description = None):
-        # calculate anomalies
-        elements = elements[1:] #ignore the isolated nodes
-        avg_elements = np.mean(elements)
-        std_elements = np.std(elements)
-        
-        unusual_elements = [i for i in range(len(elements)) 
-                            if (elements[i] > avg_elements + clustering_threshold * std_elements) 
-                            or  (elements[i] < avg_elements - clustering_threshold * std_elements)]
-        
-        # print anomalies & update predicted label
-        for cluster in unusual_elements:
-            if to_print:
-                print(f"Cluster {cluster} is anomaly with the nodes:")
-            for i, node in enumerate(clusters):
-                if node == cluster:
-                    curr_node = graph.nodes[list_nodes[i]]
-                    curr_node["pred"] = True
-                    curr_node["cluster_pred"] = True
-                    curr_node["color"] = "lightgreen" if curr_node["label"] else "yellow"
-                    curr_node["cluster"] = cluster # CHECK
-                    if dataset_type != 'packets_csv':
-                        pred[node_to_index[list_nodes[i]]] = True
-                    
-                    if to_print:
-                        print(f"found ({description}) anomaly in node: {graph.nodes[list_nodes[i]]}")
+    if detections is None:
+        detections = detect_cluster_anomalies(embeddings, clusters)
+    groups, unusual = detections
+    
+    # Check for anomaly clusters amount, densities and distances between centroids
+    labels = np.asarray(clusters)
+    verdicts.label[:len(labels)] = labels
+    # Group of every node, the deviations start at the first cluster (isolated nodes have none)
+    _, inverse, _, _, _ = groups
+    first = first_cluster(groups[0])
+    scored = labels >= 0
+    for description, unusual_elements, deviations in unusual:
+        # Deviation of the cluster of every node relative to the threshold
+        node_deviations = np.zeros(len(labels))
+        node_deviations[scored] = deviations[inverse[scored] - first]
+        verdicts.raise_score(node_deviations, 0, clustering_threshold, scored)
+        for cluster, deviation in unusual_elements:
+            # Touch only the members of the flagged cluster
+            members = cluster_members(groups, cluster)
+            verdicts.pred[members] = True
+            verdicts.cluster_pred[members] = True
+            # The flagged cluster shown with the node (the last one when several statistics flag it)
+            verdicts.cluster[members] = cluster
+            
             if to_print:
-                print()
-        
-    # Check for anomaly clusters amount
-    cluster_counts = count_vectors_in_clusters(clusters)
-    check_and_print_anomalies(list(cluster_counts.values()), 'amount')
-
-    # Check for anomaly clusters densities
-    cluster_densities = calculate_density(embeddings, clusters)
-    check_and_print_anomalies(cluster_densities, "density")
+                for i in members:
+                    alert_writer.emit(graph, list_nodes[i], 'clustering', description, deviation, cluster)
     
-    # Check for anomaly distances between centroids
-    centroids = find_centroids(embeddings, clusters)
-    centroid_distances = calculate_centroid_distances(centroids)
-    check_and_print_anomalies(centroid_distances, "distances")
-    if to_print:
-        print()
+    verdicts.write_back(graph, before, pred, node_to_index, list_nodes)
@@ -20,6 +20,64 @@ ann_threshold = 15
 ann_history_threshold = 20
 clustering_threshold = 5
 network_threshold = 14
+network_window_size = 10000 # vectors kept in the per-flow detector index
+network_baseline_size = 10000 # normal mean distances kept for the per-flow baseline
+network_plot_interval = 1000 # plot the per-flow vectors every n flows
+
+concurrent_detectors = True # run clustering and ANN concurrently in 'combined' mode
+pipelined_ingestion = True # parse the input in a producer thread while the batches are analyzed
+ingestion_queue_size = 16 # chunks buffered between the parser and the detection
+ingestion_chunk_size = 256 # records per chunk
+adaptive_batch_size = False # adapt the number of flows per batch (F) to the traffic, the F given on the command line is the initial F
+detection_latency_target = 10.0 # seconds from a flow's arrival to its verdict (filling the batch + analyzing it)
+detection_max_cpu_share = 0.5 # max share of the time spent analyzing batches
+adaptive_min_flows = 100
+adaptive_max_flows = 100000
+adaptive_smoothing = 0.5 # weight of the previous measurements in the moving averages
+instrumentation_file = None # e.g. 'pipeline_stats.jsonl': append per-batch stage timings and resource usage as JSON lines
+alert_sink = 'stdout' # 'stdout', 'jsonl', 'sqlite', 'socket' (JSON lines to a local listener) or None (only count the alerts)
+alert_path = None # file of the jsonl/sqlite sink, Unix socket path or host:port of the socket sink (None: alerts.jsonl, alerts.db, /tmp/gnn_anomaly_alerts.sock)
+alert_batch_size = 256 # records per write
+alert_flush_interval = 1.0 # seconds a partial batch waits for more records
+alert_queue_size = 100000 # records buffered for the writer thread (the detectors wait when it is full)
+alert_max_bytes = 100 * 1024 * 1024 # rotate the jsonl file at this size (0: never)
+alert_backups = 5 # rotated jsonl files kept
+alert_suppression_window = 10 # batches in which a reported node is only reported again with a new reason (0: report every batch)
+evaluation_file = None # e.g. 'evaluation.jsonl': append the cumulative confusion counts, TPR/FPR, new detections and detection latency after every batch
+score_recording_dir = None # e.g. 'scores': save the raw detector statistics of every batch for threshold_sweep.py
+artifact_cache_dir = None # e.g. 'artifact_cache': reuse the embeddings and cluster labels computed for the same input in earlier runs
+service_address = '/tmp/gnn_anomaly_flows.sock' # service.py: Unix socket path (JSON lines) or host:port (HTTP) on which the flow records are received
+service_queue_size = 64 # requests buffered for the detection (the senders wait when it is full)
+service_poll_interval = 1.0 # seconds the idle service waits for flows before checking the time trigger
+detection_time_window = None # seconds (traffic time, wall-clock time in live modes) after which a batch runs even with less than F flows, None: F flows only (live Elasticsearch mode then analyzes every poll)
+
+clustering_mode = 'full' # 'full' (fit HDBSCAN every batch), 'online' (periodic refits + approximate_predict) or 'sampled'
+clustering_refit_interval = 10 # batches between full refits in 'online' mode
+clustering_max_drift = 0.2 # refit earlier when this fraction of the nodes is new or moved since the last fit
+clustering_update_tolerance = 1e-5
+clustering_sample_threshold = 100000 # 'sampled' mode: above this number of nodes HDBSCAN runs on a sample
+clustering_sample_size = 20000 # nodes in the stratified (by side) sample, the others are assigned with approximate_predict
+min_cluster_size = 5
+clustering_algorithm_type = 'best' # HDBSCAN algorithm: 'best', 'generic', 'prims_kdtree', 'prims_balltree', 'boruvka_kdtree' or 'boruvka_balltree'
+clustering_core_dist_n_jobs = -1 # parallel jobs for the core distances, -1 means all cores
+clustering_leaf_size = 40
+clustering_gen_min_span_tree = False # only needed for diagnostics (plotting the minimum spanning tree)
+clustering_knn_graph = False # experimental: cluster a precomputed sparse kNN graph instead of the embeddings (always HDBSCAN 'generic', loses most detections on slowhttptest)
+clustering_knn_neighbors = 15
+
+ann_backend = 'annoy' # 'annoy' (new index every batch), 'hnsw' (persistent index updated incrementally), 'exact' or 'auto'
+exact_knn_max_nodes = 1000 # 'auto' uses exact kNN up to this number of nodes and Annoy above it
+exact_knn_block_bytes = 64 * 1024 * 1024
+ann_query_jobs = -1 # threads for neighbor queries, -1 means all cores
+ann_query_chunk_size = 256
+ann_tuning_file = 'ann_tuning.json' # Annoy n_trees/search_k per graph-size bucket, written by tune_ann.py
+ann_recall_target = 0.95
+ann_shared_index_dir = None # e.g. '/dev/shm': build the per-batch Annoy index into a memory-mapped file there
+ann_query_processes = 0 # processes that mmap the shared index and score it in parallel (0 = query in this process)
+hnsw_m = 16
+hnsw_ef_construction = 200
+hnsw_ef = 50
+hnsw_update_tolerance = 1e-5
 
 hidden_size = 128
 output_size = 64
@@ -3,22 +3,17 @@ import csv
 from tri_graph import TriGraph
 from network import ANN
 from results import measure_results
+from alerts import alert_writer
 from execute_pipeline import execute_pipeline
+from ingestion import Pipelined
+from scheduler import DetectionScheduler, parse_timestamp
+from instrumentation import recorder
+from artifact_cache import open_artifact_cache
 
-def process_flows(dic_feature_to_name, input_file_path=None, num_of_flows=None, num_of_rows=-1, algo='clustering', plot=False):
-                
-    if algo in ['ann', 'clustering', 'combined']:
-        tri_graph = TriGraph()
-    
-    else:
-        print("No valid algorithm specified.")
-        return
-        
+# Producer stage: parse the CSV and yield the TCP flows with their row index
+def read_flows(dic_feature_to_name, input_file_path, num_of_rows=-1):
     with open(input_file_path, mode='r') as file:
         csv_reader = csv.DictReader(file)
-        pred = []
-        label = []
-        node_to_index = {}
         
         # Iterate through each line in the CSV
         for i, row in enumerate(csv_reader):
@@ -31,11 +26,34 @@ def process_flows(dic_feature_to_name, input_file_path=None, num_of_flows=None,
             if row[dic_feature_to_name['Protocol']] != dic_feature_to_name['TCP']:
                 continue
             
-            tri_graph.add_flow_to_graph(row, pred, label, node_to_index, dic_feature_to_name)
+            yield i, row
 
-            if i and i % num_of_flows == 0:
-                execute_pipeline(tri_graph, algo, plot, pred, node_to_index)
-                
-        execute_pipeline(tri_graph, algo, plot, pred, node_to_index)
+def process_flows(dic_feature_to_name, input_file_path=None, num_of_flows=None, num_of_rows=-1, algo='clustering', plot=False):
                 
-        measure_results(tri_graph.graph)
\ No newline at end of file
+    if algo in ['ann', 'clustering', 'combined']:
+        tri_graph = TriGraph()
+    
+    else:
+        print("No valid algorithm specified.")
+        return
+        
+    pred = []
+    label = []
+    node_to_index = {}
+    scheduler = DetectionScheduler(num_of_flows)
+    tri_graph.artifact_cache = open_artifact_cache(input_file_path, reader='flows', feature_to_name=dic_feature_to_name)
+    
+    # Consumer stage: apply the flows to the graph, the next rows are parsed meanwhile
+    for _, row in Pipelined(recorder.timed_iterator(read_flows(dic_feature_to_name, input_file_path, num_of_rows), 'parse')):
+        with recorder.stage('graph_update'):
+            tri_graph.add_flow_to_graph(row, pred, label, node_to_index, dic_feature_to_name)
+        scheduler.add_flow(parse_timestamp(row[dic_feature_to_name['Timestamp']]))
+
+        # Compute the embeddings and the ANN every F flows or T seconds of traffic
+        if scheduler.due():
+            scheduler.detect(execute_pipeline, tri_graph, algo, plot, pred, node_to_index)
+            
+    scheduler.detect(execute_pipeline, tri_graph, algo, plot, pred, node_to_index)
+            
+    alert_writer.flush()
+    measure_results(tri_graph.graph, tri_graph.evaluator)
@@ -0,0 +1,83 @@
+import json
+import time
+import numpy as np
+from itertools import islice
+
+from config import evaluation_file
+
+# Evaluation updated after every batch instead of once at the end: the confusion counts follow
+# the nodes that joined the graph and the predictions that flipped in the batch, every batch adds
+# a point to the timeline (cumulative TPR/FPR, new detections, detection latency) and, when
+# evaluation_file is set, appends it as a JSON line. The continuous scores of the nodes
+# (Verdicts.score) give the ROC and PR curves at the end.
+class StreamingEvaluator():
+    def __init__(self, path=evaluation_file) -> None:
+        self.path = path
+        self.batch = 0
+        self.labels = np.zeros(0, dtype=bool)
+        self.first_batch = np.zeros(0, dtype=np.int64) # batch in which the node was first analyzed
+        self.first_time = np.zeros(0) # and its time
+        self.detected_batch = np.zeros(0, dtype=np.int64) # batch of the first positive prediction, -1 if none
+        self.pred = np.zeros(0, dtype=bool)
+        self.tp, self.fp, self.fn, self.tn = 0, 0, 0, 0
+        self.latencies = [] # (batches, seconds) from first analysis to detection of every detected attack node
+        self.timeline = []
+        self.verdicts = None
+
+    # Labels of the nodes added to the graph since the previous batch, all counted as negative predictions
+    def add_nodes(self, graph, now):
+        labels = np.fromiter((label for _, label in islice(graph.nodes(data='label'), len(self.labels), None)), dtype=bool)
+        added = len(labels)
+        self.labels = np.concatenate([self.labels, labels])
+        self.first_batch = np.concatenate([self.first_batch, np.full(added, self.batch)])
+        self.first_time = np.concatenate([self.first_time, np.full(added, now)])
+        self.detected_batch = np.concatenate([self.detected_batch, np.full(added, -1)])
+        self.pred = np.concatenate([self.pred, np.zeros(added, dtype=bool)])
+        self.fn += int(labels.sum())
+        self.tn += added - int(labels.sum())
+
+    # Count the batch: the new nodes and the predictions that changed since the previous batch
+    def update(self, graph, verdicts):
+        now = time.time()
+        self.verdicts = verdicts
+        self.add_nodes(graph, now)
+
+        flipped = np.flatnonzero(verdicts.pred[:len(self.pred)] != self.pred)
+        positive, labels = verdicts.pred[flipped], self.labels[flipped]
+        new_tp, new_fp = int(np.sum(positive & labels)), int(np.sum(positive & ~labels))
+        # Flipped to positive minus flipped back to negative
+        true_positives, false_positives = new_tp - int(np.sum(~positive & labels)), new_fp - int(np.sum(~positive & ~labels))
+        self.tp, self.fn = self.tp + true_positives, self.fn - true_positives
+        self.fp, self.tn = self.fp + false_positives, self.tn - false_positives
+        self.pred[flipped] = positive
+
+        detected = flipped[positive & labels & (self.detected_batch[flipped] == -1)]
+        self.detected_batch[detected] = self.batch
+        latencies = list(zip(self.batch - self.first_batch[detected], now - self.first_time[detected]))
+        self.latencies += latencies
+
+        point = {
+            'batch': self.batch,
+            'time': now,
+            'nodes': len(self.labels),
+            'tp': self.tp, 'fp': self.fp, 'fn': self.fn, 'tn': self.tn,
+            'tpr': self.tp / max(self.tp + self.fn, 1),
+            'fpr': self.fp / max(self.fp + self.tn, 1),
+            'new_tp': new_tp,
+            'new_fp': new_fp,
+            'detection_latency_batches': float(np.mean([batches for batches, _ in latencies])) if latencies else None,
+            'detection_latency_seconds': float(np.mean([seconds for _, seconds in latencies])) if latencies else None,
+        }
+        self.timeline.append(point)
+        self.batch += 1
+        if self.path is not None:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(point) + '\n')
+
+    # Continuous score of every node, the nodes no detector scored rank lowest and the nodes
+    # above the mean of a zero-std statistic (+inf) rank highest
+    def scores(self):
+        scores = self.verdicts.score[:len(self.labels)]
+        finite = np.isfinite(scores)
+        lowest, highest = (scores[finite].min(), scores[finite].max()) if finite.any() else (0.0, 0.0)
+        return np.where(finite, scores, np.where(scores > 0, highest + 1, lowest - 1))
@@ -1,23 +1,119 @@
+import numpy as np
+import torch
 from visualization import plot_embeddings
 from combined_algo import check_anomalies
-from ann import ann_algorithm
+from concurrent.futures import ThreadPoolExecutor
+
+from ann import ann_algorithm, ann_anomaly_scores, NUM_NEIGHBORS
 from tri_graph import TriGraph
-from clustering import check_all_anomalies, clustering_algorithm
+from clustering import check_all_anomalies, clustering_algorithm, detect_cluster_anomalies, OnlineClusterer
+from graph_embedding import create_batched_embeddings
+from hnsw_index import HNSWIndex
+from knn import exact_knn
+from instrumentation import recorder
+from verdicts import Verdicts
+from evaluation import StreamingEvaluator
+from score_recording import score_recorder
+from config import ann_backend, output_size, clustering_mode, clustering_knn_graph, clustering_knn_neighbors
+from config import concurrent_detectors
+
+# Cluster the embeddings and find the unusual clusters (reads the graph, never mutates it)
+def cluster_embeddings_of(tri_graph:TriGraph, cluster_embeddings, knn=None):
+    with recorder.stage('hdbscan'):
+        if clustering_mode == 'online':
+            if tri_graph.clusterer is None:
+                tri_graph.clusterer = OnlineClusterer()
+            clusters = tri_graph.clusterer.labels_of(cluster_embeddings)
+        else:
+            # Labels of the same graph state computed in an earlier run are reused from the artifact cache
+            # (not in online mode, its clusterer keeps state across batches)
+            cache = tri_graph.artifact_cache
+            clusters_key = cache.key(tri_graph, 'clusters') if cache is not None else None
+            clusters = cache.load(clusters_key, 'clusters') if clusters_key is not None else None
+            if clusters is None:
+                sides = [side for _, side in tri_graph.graph.nodes(data='side')] if clustering_mode == 'sampled' else None
+                clusters = clustering_algorithm(cluster_embeddings, knn, sides)
+                if clusters_key is not None:
+                    cache.store(clusters_key, 'clusters', clusters)
+    with recorder.stage('cluster_statistics'):
+        detections = detect_cluster_anomalies(cluster_embeddings, clusters)
+    return clusters, detections
 
-def execute_pipeline(tri_graph:TriGraph, algo:str, plot:bool, pred=[], node_to_index={}):
+def execute_pipeline(tri_graph:TriGraph, algo:str, plot:bool, pred=[], node_to_index={}, embeddings=None):
     # print("Checking anomalies...")
-    embeddings = tri_graph.create_embeddings()
-    if algo == 'clustering' or algo == 'combined':
-        cluster_embeddings = embeddings.detach().numpy()
-        clusters = clustering_algorithm(cluster_embeddings)
-        # check_all_anomalies(tri_graph.graph, cluster_embeddings, clusters, pred, node_to_index, algo != 'combined')
-        check_all_anomalies(tri_graph.graph, cluster_embeddings, clusters, pred, node_to_index, True)
-    if algo == 'ann' or algo == 'combined':
-        # ann_algorithm(tri_graph.graph, embeddings.detach().numpy(), algo != 'combined', algo)
-        ann_algorithm(tri_graph.graph, embeddings.detach().numpy(), True, algo, pred, node_to_index)
+    # The separated packet readers do not keep a prediction list, give them a throwaway one
+    if not node_to_index:
+        node_to_index = {node: i for i, node in enumerate(tri_graph.graph.nodes)}
+        pred = [False] * len(node_to_index)
+    recorder.set('nodes', tri_graph.graph.number_of_nodes())
+    recorder.set('edges', tri_graph.graph.number_of_edges())
+    # Embeddings of the same graph state computed in an earlier run are reused from the artifact cache
+    cache = tri_graph.artifact_cache
+    embeddings_key = cache.key(tri_graph, 'embeddings') if cache is not None and embeddings is None else None
+    node_embeddings = cache.load(embeddings_key, 'embeddings') if embeddings_key is not None else None
+    if node_embeddings is None:
+        if embeddings is None:
+            embeddings = tri_graph.create_embeddings()
+        # One read-only embedding buffer shared by both detectors
+        node_embeddings = embeddings.detach().numpy()
+        if embeddings_key is not None:
+            cache.store(embeddings_key, 'embeddings', node_embeddings)
+    run_clustering = algo == 'clustering' or algo == 'combined'
+    run_ann = algo == 'ann' or algo == 'combined'
+    
+    knn = None
+    if run_clustering and clustering_knn_graph:
+        # One exact kNN serves both the clustering graph and the exact ANN scores
+        with recorder.stage('knn'):
+            knn = exact_knn(node_embeddings, max(clustering_knn_neighbors, NUM_NEIGHBORS - 1), exclude_self=True)
+    if run_ann and ann_backend == 'hnsw' and tri_graph.ann_index is None:
+        tri_graph.ann_index = HNSWIndex(output_size)
+    
+    # Both detectors spend their time in native code, so in combined mode they run concurrently
+    if run_clustering and run_ann and concurrent_detectors:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            clustering_future = executor.submit(cluster_embeddings_of, tri_graph, node_embeddings, knn)
+            ann_future = executor.submit(ann_anomaly_scores, node_embeddings, tri_graph.ann_index, knn)
+            clusters, detections = clustering_future.result()
+            anomaly_scores = ann_future.result()
+    else:
+        if run_clustering:
+            clusters, detections = cluster_embeddings_of(tri_graph, node_embeddings, knn)
+        if run_ann:
+            anomaly_scores = ann_anomaly_scores(node_embeddings, tri_graph.ann_index, knn)
+    
+    # Merge the verdicts in a fixed order: the ANN verdict of combined mode reads the cluster verdict
+    if tri_graph.verdicts is None:
+        tri_graph.verdicts = Verdicts()
+    tri_graph.verdicts.resize(len(node_embeddings))
+    with recorder.stage('alerts'):
+        if run_clustering:
+            # check_all_anomalies(tri_graph.graph, node_embeddings, clusters, pred, node_to_index, algo != 'combined')
+            check_all_anomalies(tri_graph.graph, node_embeddings, clusters, pred, node_to_index, True, detections, tri_graph.verdicts)
+        if run_ann:
+            # ann_algorithm(tri_graph.graph, node_embeddings, algo != 'combined', algo)
+            ann_algorithm(tri_graph.graph, node_embeddings, True, algo, pred, node_to_index, anomaly_scores=anomaly_scores, verdicts=tri_graph.verdicts)
     # if algo == 'combined':
-    #     check_anomalies(tri_graph.graph)
+    #     check_anomalies(tri_graph.graph, tri_graph.verdicts)
+    
+    if tri_graph.evaluator is None:
+        tri_graph.evaluator = StreamingEvaluator()
+    tri_graph.evaluator.update(tri_graph.graph, tri_graph.verdicts)
+    score_recorder.emit(tri_graph.evaluator.labels)
 
     if plot:
+        if embeddings is None:
+            embeddings = torch.from_numpy(np.array(node_embeddings))
         tri_graph.visualize_directed_graph()
-        plot_embeddings(embeddings, tri_graph.graph)
\ No newline at end of file
+        plot_embeddings(embeddings, tri_graph.graph)
+
+# Run the pipeline on several tri-graphs (one per site/sensor) with a single GCN forward pass
+def execute_pipelines(tri_graphs, algo:str, plot:bool, preds=None, node_to_indexes=None):
+    if preds is None:
+        preds = [[data['pred'] for _, data in tri_graph.graph.nodes(data=True)] for tri_graph in tri_graphs]
+    if node_to_indexes is None:
+        node_to_indexes = [{node: i for i, node in enumerate(tri_graph.graph.nodes)} for tri_graph in tri_graphs]
+    
+    batched_embeddings = create_batched_embeddings(tri_graphs)
+    for tri_graph, embeddings, pred, node_to_index in zip(tri_graphs, batched_embeddings, preds, node_to_indexes):
+        execute_pipeline(tri_graph, algo, plot, pred, node_to_index, embeddings)
@@ -5,8 +5,14 @@ from vector import Vector
 from tri_graph import TriGraph
 from visualization import plot_ann_indexes
 from network import ANN
+from config import network_plot_interval
 from results import measure_results
+from alerts import alert_writer
 from execute_pipeline import execute_pipeline
+from ingestion import Pipelined
+from scheduler import DetectionScheduler
+from instrumentation import recorder
+from artifact_cache import open_artifact_cache
 
 def update_flow_state(flow, packet):
     fin_flag = packet.tcp.flags_fin == '1'
@@ -39,93 +45,110 @@ def find_packet_time(packet):
     ts = int(float(packet.frame_info.time_epoch))
     return ts
 
+# Producer stage: aggregate the captured packets into flows and yield every finished flow.
+# The capture is opened here so its event loop belongs to the thread that reads it.
+def separate_flows_pcap(pcap_file, num_of_rows=-1):
+    cap = FileCapture(pcap_file)
+    streams = {}
+
+    # Close the capture (and its tshark process) also when the consumer stops early or a packet fails
+    try:
+        for i, packet in enumerate(cap):
+            if i == num_of_rows:
+                break
+        
+            if i % 10000 == 0:
+                print(f'processed {i} packets')
+            
+            # Check only TCP packets
+            if hasattr(packet, 'ip') and hasattr(packet, 'tcp'):
+
+                # Skip retransmission packets
+                if 'analysis_retransmission' in dir(packet.tcp):
+                    continue
+
+                # Get the ip, port for the src and dst
+                src_ip, dst_ip = packet.ip.src, packet.ip.dst
+                dest_port = packet[packet.transport_layer].dstport if hasattr(
+                    packet, 'transport_layer') else None
+                src_port = packet[packet.transport_layer].srcport if hasattr(
+                    packet, 'transport_layer') else None
+            
+                # Get the stream numner from the TCP packet
+                stream_number = int(packet.tcp.stream)
+
+                flags = {
+                    'FIN': int(packet.tcp.flags_fin),
+                    'SYN': int(packet.tcp.flags_syn),
+                    'RST': int(packet.tcp.flags_reset),
+                    'PSH': int(packet.tcp.flags_push),
+                    'ACK': int(packet.tcp.flags_ack),
+                    'URG': int(packet.tcp.flags_urg),
+                }
+            
+                if int(src_port) > int(dest_port):
+                    src, dst, fwd = f'{src_ip}:{src_port}', f'{dst_ip}:{dest_port}', True
+                else:
+                    dst, src, fwd = f'{src_ip}:{src_port}', f'{dst_ip}:{dest_port}', False
+            
+                if stream_number not in streams: # Got a new flow number
+                    # Skip single resets packets
+                    if packet.tcp.flags_reset == '1':
+                        continue
+                
+                    streams[stream_number] = Vector(len(packet), src, dst, fwd, stream_number, flags)
+                else: # New packet of existing flow
+                    vector = streams[stream_number]
+                    # Aggregate the packet's feature to the existing flow
+                    vector.add_packet(len(packet), packet.tcp.time_delta, src, flags)
+
+                vector = streams[stream_number]
+                update_flow_state(vector, packet)
+                # End a flow in FYN or RST flag is opened
+                if vector.state == 'CLOSED':
+                    # Add the whole flow - after he terminated to tri_graph
+                    vector.packet_index = find_packet_time(packet)
+                    streams.pop(stream_number)
+                    yield i, stream_number, vector
+    finally:
+        cap.close()
+
 def separate_packets_pcap(pcap_file, num_of_rows=-1, algo='ann', plot=True, num_of_flows=2000):
     
     if algo == 'network':
         ann = ANN()
     elif algo in ['ann', 'clustering', 'combined']:
         tri_graph = TriGraph()
+        tri_graph.artifact_cache = open_artifact_cache(pcap_file, reader='packets_pcap')
     
     def flow_finished(vector):
         if algo == 'network' and ann.add_vector(vector)[0] == 'anomaly':
             print(f'anomaly on index {i}, stream: {stream_number}, vector: {vector}\n')
+        if algo == 'network' and plot and ann.number_of_vectors % network_plot_interval == 0:
+            plot_ann_indexes(np.array(ann.vectors))
         elif algo in ['ann', 'clustering', 'combined']:
             tri_graph.add_separated_flow_to_graph(vector)
     
-    cap = FileCapture(pcap_file)
-    prev_count_flows = 0
+    scheduler = DetectionScheduler(num_of_flows)
 
-    streams = {}
-    
-    for i, packet in enumerate(cap):
-        if i == num_of_rows:
-            break
+    # Consumer stage: apply the finished flows to the graph, the next packets are parsed meanwhile
+    for i, stream_number, vector in Pipelined(recorder.timed_iterator(separate_flows_pcap(pcap_file, num_of_rows), 'parse')):
+        with recorder.stage('graph_update'):
+            flow_finished(vector)
         
-        if i % 10000 == 0:
-            print(f'processed {i} packets')
-            
-        # Check only TCP packets
-        if hasattr(packet, 'ip') and hasattr(packet, 'tcp'):
-
-            # Skip retransmission packets
-            if 'analysis_retransmission' in dir(packet.tcp):
-                continue
-
-            # Get the ip, port for the src and dst
-            src_ip, dst_ip = packet.ip.src, packet.ip.dst
-            dest_port = packet[packet.transport_layer].dstport if hasattr(
-                packet, 'transport_layer') else None
-            src_port = packet[packet.transport_layer].srcport if hasattr(
-                packet, 'transport_layer') else None
-            
-            # Get the stream numner from the TCP packet
-            stream_number = int(packet.tcp.stream)
-
-            flags = {
-                'FIN': int(packet.tcp.flags_fin),
-                'SYN': int(packet.tcp.flags_syn),
-                'RST': int(packet.tcp.flags_reset),
-                'PSH': int(packet.tcp.flags_push),
-                'ACK': int(packet.tcp.flags_ack),
-                'URG': int(packet.tcp.flags_urg),
-            }
-            
-            if int(src_port) > int(dest_port):
-                src, dst, fwd = f'{src_ip}:{src_port}', f'{dst_ip}:{dest_port}', True
-            else:
-                dst, src, fwd = f'{src_ip}:{src_port}', f'{dst_ip}:{dest_port}', False
-            
-            if stream_number not in streams: # Got a new flow number
-                # Skip single resets packets
-                if packet.tcp.flags_reset == '1':
-                    continue
-                
-                streams[stream_number] = Vector(len(packet), src, dst, fwd, stream_number, flags)
-            else: # New packet of existing flow
-                vector = streams[stream_number]
-                # Aggregate the packet's feature to the existing flow
-                vector.add_packet(len(packet), packet.tcp.time_delta, src, flags)
-
-            vector = streams[stream_number]
-            update_flow_state(vector, packet)
-            # End a flow in FYN or RST flag is opened
-            if vector.state == 'CLOSED':
-                # Add the whole flow - after he terminated to tri_graph
-                vector.packet_index = find_packet_time(packet)
-                flow_finished(vector)
-                streams.pop(stream_number)
-            
         if algo == 'network':
-            if plot:
-                plot_ann_indexes(np.array(ann.vectors))
             continue
+        scheduler.add_flow(vector.packet_index)
         
-        # Compute the embeddings and the ANN every X flows
-        if tri_graph.count_flows - prev_count_flows >= num_of_flows:
-            execute_pipeline(tri_graph, algo, plot)
-            prev_count_flows = tri_graph.count_flows
+        # Compute the embeddings and the ANN every F flows or T seconds of traffic
+        if scheduler.due():
+            scheduler.detect(execute_pipeline, tri_graph, algo, plot)
         
 
-    execute_pipeline(tri_graph, algo, plot)
+    # The per-flow detector has no tri-graph, its anomalies are reported as the flows finish
+    if algo != 'network':
+        scheduler.detect(execute_pipeline, tri_graph, algo, plot)
     
-    measure_results(tri_graph.graph)
+    alert_writer.flush()
+    if algo != 'network':
+        measure_results(tri_graph.graph, tri_graph.evaluator)
@@ -5,8 +5,14 @@ from vector import Vector
 from tri_graph import TriGraph
 from visualization import plot_ann_indexes
 from network import ANN
+from config import network_plot_interval
 from results import measure_results
+from alerts import alert_writer
 from execute_pipeline import execute_pipeline
+from ingestion import Pipelined
+from scheduler import DetectionScheduler
+from instrumentation import recorder
+from artifact_cache import open_artifact_cache
 
 def update_flow_state(flow, row):
     fin_flag = row['tcp.flags.fin'] == '1'
@@ -39,23 +45,10 @@ def find_packet_time(row):
     ts = int(float(row['frame.time_epoch']))
     return ts
 
-def separate_packets_csv(pcap_file, num_of_rows=-1, algo='ann', plot=True, num_of_flows=2000):
-    
-    if algo == 'network':
-        ann = ANN()
-    elif algo in ['ann', 'clustering', 'combined']:
-        tri_graph = TriGraph()
-    
-    def flow_finished(vector):
-        if algo == 'network' and ann.add_vector(vector)[0] == 'anomaly':
-            print(f'anomaly on index {i}, stream: {stream_number}, vector: {vector}\n')
-        elif algo in ['ann', 'clustering', 'combined']:
-            tri_graph.add_separated_flow_to_graph(vector)
-    
+# Producer stage: aggregate the packets into flows and yield every finished flow
+def separate_flows_csv(pcap_file, num_of_rows=-1):
     with open(pcap_file, mode='r') as file:
         csv_reader = csv.DictReader(file)
-        
-        prev_count_flows = 0
 
         streams = {}
         # Iterate through each line in the CSV
@@ -109,19 +102,44 @@ def separate_packets_csv(pcap_file, num_of_rows=-1, algo='ann', plot=True, num_o
             if vector.state == 'CLOSED':
                 # Add the whole flow - after he terminated to tri_graph
                 vector.packet_index = find_packet_time(row)
-                flow_finished(vector)
                 streams.pop(stream_number)
-            
-            if algo == 'network':
-                if plot:
-                    plot_ann_indexes(np.array(ann.vectors))
-                continue
+                yield i, stream_number, vector
+
+def separate_packets_csv(pcap_file, num_of_rows=-1, algo='ann', plot=True, num_of_flows=2000):
+    
+    if algo == 'network':
+        ann = ANN()
+    elif algo in ['ann', 'clustering', 'combined']:
+        tri_graph = TriGraph()
+        tri_graph.artifact_cache = open_artifact_cache(pcap_file, reader='packets_csv')
+    
+    def flow_finished(vector):
+        if algo == 'network' and ann.add_vector(vector)[0] == 'anomaly':
+            print(f'anomaly on index {i}, stream: {stream_number}, vector: {vector}\n')
+        if algo == 'network' and plot and ann.number_of_vectors % network_plot_interval == 0:
+            plot_ann_indexes(np.array(ann.vectors))
+        elif algo in ['ann', 'clustering', 'combined']:
+            tri_graph.add_separated_flow_to_graph(vector)
+    
+    scheduler = DetectionScheduler(num_of_flows)
+
+    # Consumer stage: apply the finished flows to the graph, the next packets are parsed meanwhile
+    for i, stream_number, vector in Pipelined(recorder.timed_iterator(separate_flows_csv(pcap_file, num_of_rows), 'parse')):
+        with recorder.stage('graph_update'):
+            flow_finished(vector)
+        
+        if algo == 'network':
+            continue
+        scheduler.add_flow(vector.packet_index)
 
-            # Compute the embeddings and the ANN every X flows
-            if tri_graph.count_flows - prev_count_flows >= num_of_flows:
-                execute_pipeline(tri_graph, algo, plot)
-                prev_count_flows = tri_graph.count_flows
+        # Compute the embeddings and the ANN every F flows or T seconds of traffic
+        if scheduler.due():
+            scheduler.detect(execute_pipeline, tri_graph, algo, plot)
 
-    execute_pipeline(tri_graph, algo, plot)
+    # The per-flow detector has no tri-graph, its anomalies are reported as the flows finish
+    if algo != 'network':
+        scheduler.detect(execute_pipeline, tri_graph, algo, plot)
 
-    measure_results(tri_graph.graph)
+    alert_writer.flush()
+    if algo != 'network':
+        measure_results(tri_graph.graph, tri_graph.evaluator)
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 from torch_geometric.nn import GCNConv
 
+from instrumentation import recorder
 from config import features, hidden_size, output_size
 
 # Define a Graph Convolutional Network (GCN) model for generating embeddings
@@ -18,20 +19,27 @@ class GCN(torch.nn.Module):
         x = self.conv2(x, edge_index)
         return x
 
-def create_embeddings(self):
+# Convert the node features and the edges of a graph to PyTorch tensors
+def graph_to_tensors(graph):
         # Convert node features to PyTorch tensors
-        node_features = torch.FloatTensor([list([self.graph.nodes[node][feature]/self.graph.nodes[node]['flows'] for feature in features]) 
-                                           for node in self.graph.nodes])
+        node_features = torch.FloatTensor([list([graph.nodes[node][feature]/graph.nodes[node]['flows'] for feature in features]) 
+                                           for node in graph.nodes])
 
         # Convert edges to PyTorch tensors
-        node_to_index = {node: i for i, node in enumerate(self.graph.nodes())}
-        edges = [(node_to_index[u], node_to_index[v]) for u, v in self.graph.edges()]
+        node_to_index = {node: i for i, node in enumerate(graph.nodes())}
+        edges = [(node_to_index[u], node_to_index[v]) for u, v in graph.edges()]
 
         # Convert the list of edges to a NumPy array
-        edges_array = np.array(edges)
+        edges_array = np.array(edges, dtype=np.int64).reshape(-1, 2)
 
         # Convert the NumPy array to a PyTorch tensor
         edge_index = torch.tensor(edges_array, dtype=torch.long).t().contiguous()
+        
+        return node_features, edge_index
+
+def create_embeddings(self):
+        with recorder.stage('features'):
+            node_features, edge_index = graph_to_tensors(self.graph)
 
         # Initialize the neural network
         num_features = len(node_features[0])
@@ -41,6 +49,34 @@ def create_embeddings(self):
         self.gcn_model.train()
         self.gcn_model.eval()
 
-        embeddings = self.gcn_model(node_features, edge_index)
+        with recorder.stage('gcn_forward'):
+            embeddings = self.gcn_model(node_features, edge_index)
                 
         return embeddings
+
+# Embed several tri-graphs in one forward pass over their disjoint union
+def create_batched_embeddings(tri_graphs):
+        with recorder.stage('features'):
+            tensors = [graph_to_tensors(tri_graph.graph) for tri_graph in tri_graphs]
+        sizes = [node_features.shape[0] for node_features, _ in tensors]
+
+        # Stack the feature matrices and shift every edge index by the offset of its graph,
+        # so the batch is one block-diagonal graph and no message crosses between graphs
+        offsets = np.cumsum([0] + sizes[:-1])
+        node_features = torch.cat([node_features for node_features, _ in tensors], dim=0)
+        edge_index = torch.cat([edge_index + int(offset) for (_, edge_index), offset in zip(tensors, offsets)], dim=1)
+
+        # All the models share the same seed, so a single model serves the whole batch
+        gcn_model = next((tri_graph.gcn_model for tri_graph in tri_graphs if tri_graph.gcn_model is not None), None)
+        if gcn_model is None:
+            gcn_model = GCN(len(features), hidden_size, output_size)
+        for tri_graph in tri_graphs:
+            if tri_graph.gcn_model is None:
+                tri_graph.gcn_model = gcn_model
+        gcn_model.eval()
+
+        with torch.no_grad(), recorder.stage('gcn_forward'):
+            embeddings = gcn_model(node_features, edge_index)
+        
+        # Split the embeddings back per graph
+        return list(torch.split(embeddings, sizes, dim=0))
@@ -0,0 +1,122 @@
+import numpy as np
+import hnswlib
+
+from ann import query_jobs
+from config import hnsw_m, hnsw_ef_construction, hnsw_ef, hnsw_update_tolerance, exact_knn_block_bytes
+
+INITIAL_CAPACITY = 1024
+
+# Persistent nearest neighbor index (HNSW graph) that lives across batches.
+# Row i of the embeddings matrix is stored under label i, so only the rows whose
+# embeddings changed since the previous batch are re-inserted and re-scored, together with the
+# rows whose neighborhood they left (stored neighbors) or entered (reverse neighbors).
+class HNSWIndex():
+    def __init__(self, dim, num_neighbors=4) -> None:
+        self.dim = dim
+        self.num_neighbors = num_neighbors
+        self.index = hnswlib.Index(space='l2', dim=dim)
+        self.index.init_index(max_elements=INITIAL_CAPACITY, ef_construction=hnsw_ef_construction, M=hnsw_m)
+        self.index.set_ef(max(hnsw_ef, num_neighbors))
+
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.deleted = np.empty(0, dtype=bool)
+        self.neighbors = np.empty((0, num_neighbors), dtype=np.int64)
+        self.anomaly_scores = np.empty(0)
+        self.radius = np.empty(0) # distance to the farthest stored neighbor
+
+    # Grow the index so it can hold at least `size` elements
+    def reserve(self, size):
+        capacity = self.index.get_max_elements()
+        if size > capacity:
+            while capacity < size:
+                capacity *= 2
+            self.index.resize_index(capacity)
+
+    # Insert the new rows and re-insert the changed rows, returns the indices of both
+    def update(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        num_old = len(self.vectors)
+        num_new = len(embeddings)
+
+        # Rows that existed in the previous batch and moved more than the tolerance
+        old_rows = embeddings[:num_old]
+        changed = ~np.all(np.isclose(old_rows, self.vectors, rtol=hnsw_update_tolerance, atol=0), axis=1)
+        changed &= ~self.deleted
+        changed_ids = np.flatnonzero(changed)
+        new_ids = np.arange(num_old, num_new)
+        ids = np.concatenate([changed_ids, new_ids])
+
+        if len(ids):
+            self.reserve(num_new)
+            # Adding an existing label replaces its vector in the graph
+            self.index.add_items(embeddings[ids], ids, num_threads=query_jobs())
+
+        self.vectors = embeddings.copy()
+        self.deleted = np.concatenate([self.deleted, np.zeros(num_new - num_old, dtype=bool)])
+        self.neighbors = np.concatenate([self.neighbors, np.full((num_new - num_old, self.num_neighbors), -1)])
+        self.anomaly_scores = np.concatenate([self.anomaly_scores, np.zeros(num_new - num_old)])
+        self.radius = np.concatenate([self.radius, np.full(num_new - num_old, np.inf)])
+
+        return ids
+
+    # Remove rows from the index, they are no longer returned as neighbors nor scored
+    def delete(self, ids):
+        for i in ids:
+            if not self.deleted[i]:
+                self.index.mark_deleted(int(i))
+                self.deleted[i] = True
+        self.anomaly_scores[ids] = 0
+        self.neighbors[ids] = -1
+        self.radius[ids] = np.inf
+
+    # Query the neighbors of the given rows and store their mean distance as the anomaly score
+    def score(self, ids):
+        ids = ids[~self.deleted[ids]]
+        if len(ids) == 0:
+            return
+        k = min(self.num_neighbors, int(np.count_nonzero(~self.deleted)))
+        labels, distances = self.index.knn_query(self.vectors[ids], k=k, num_threads=query_jobs())
+
+        # hnswlib returns squared euclidean distances
+        self.anomaly_scores[ids] = np.mean(np.sqrt(distances), axis=1)
+        self.radius[ids] = np.sqrt(distances[:, -1])
+        self.neighbors[ids] = -1
+        self.neighbors[ids, :k] = labels
+
+    # Rows a moved or new vector is now closer to than their farthest neighbor: their stored
+    # neighbors are no longer their nearest ones. The number of such rows is not bounded by any k,
+    # so they are found with blocked distances from the moved vectors to all the rows (like knn.exact_knn).
+    def reverse_neighbors(self, ids, block_bytes=exact_knn_block_bytes):
+        ids = ids[~self.deleted[ids]]
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        vectors = self.vectors.astype(np.float64)
+        squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+        squared_radius = np.where(self.deleted, -np.inf, self.radius ** 2)
+        block = max(1, block_bytes // (len(vectors) * vectors.itemsize))
+
+        affected = np.zeros(len(vectors), dtype=bool)
+        for start in range(0, len(ids), block):
+            moved = ids[start:start + block]
+            squared_distances = vectors[moved] @ vectors.T
+            squared_distances *= -2
+            squared_distances += squared_norms[moved, None]
+            squared_distances += squared_norms[None, :]
+            affected |= np.any(squared_distances < squared_radius, axis=0)
+        return np.flatnonzero(affected)
+
+    # Update the index with the embeddings of the current batch and return the anomaly score of every row
+    def anomaly_scores_of(self, embeddings):
+        ids = self.update(embeddings)
+
+        # Rows that had a moved row among their neighbors, or that a moved row came close to,
+        # must be re-scored as well
+        if len(ids):
+            moved = np.zeros(len(self.vectors), dtype=bool)
+            moved[ids] = True
+            neighbors = self.neighbors[:len(self.vectors)]
+            affected = np.flatnonzero(np.any(np.where(neighbors >= 0, moved[neighbors], False), axis=1))
+            ids = np.union1d(np.union1d(ids, affected), self.reverse_neighbors(ids))
+
+        self.score(ids)
+        return self.anomaly_scores.copy()
@@ -0,0 +1,77 @@
+import threading
+from queue import Queue, Full
+
+from config import pipelined_ingestion, ingestion_queue_size, ingestion_chunk_size
+
+# Pipelined ingestion: a producer thread parses the input into flow records and hands them
+# to the consumer (the caller) through a bounded queue. Only the consumer applies the records
+# to the tri-graph and runs the detection, so every batch is analyzed on a consistent snapshot
+# while the producer keeps parsing the next window.
+
+END = object()
+
+# Wraps an exception raised by the producer so the consumer can re-raise it
+class ProducerError():
+    def __init__(self, error) -> None:
+        self.error = error
+
+# Put an item on the queue, gives up when the consumer has stopped
+def put(buffer, item, stopped):
+    while not stopped.is_set():
+        try:
+            buffer.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+# Producer thread: read the records and send them in chunks (one queue operation per chunk)
+def produce(records, buffer, stopped, chunk_size):
+    try:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                if not put(buffer, chunk, stopped):
+                    return
+                chunk = []
+        if chunk and not put(buffer, chunk, stopped):
+            return
+        put(buffer, END, stopped)
+    except BaseException as error:
+        put(buffer, ProducerError(error), stopped)
+    finally:
+        if hasattr(records, 'close'):
+            records.close()
+
+# Iterate over the records, parsed ahead by a producer thread when pipelined_ingestion is on.
+# At most queue_size chunks of chunk_size records are buffered between the two stages.
+class Pipelined():
+    def __init__(self, records, chunk_size=ingestion_chunk_size, queue_size=ingestion_queue_size) -> None:
+        self.records = records
+        self.chunk_size = chunk_size
+        self.buffer = Queue(maxsize=queue_size) if pipelined_ingestion else None
+
+    # Chunks already parsed and waiting for the consumer
+    def pending(self):
+        return self.buffer.qsize() if self.buffer is not None else 0
+
+    def __iter__(self):
+        if self.buffer is None:
+            yield from self.records
+            return
+
+        stopped = threading.Event()
+        producer = threading.Thread(target=produce, args=(self.records, self.buffer, stopped, self.chunk_size), daemon=True)
+        producer.start()
+        try:
+            while True:
+                chunk = self.buffer.get()
+                if chunk is END:
+                    return
+                if isinstance(chunk, ProducerError):
+                    raise chunk.error
+                yield from chunk
+        finally:
+            stopped.set()
+            producer.join()
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import threading
+import psutil
+from contextlib import contextmanager, nullcontext
+
+from config import instrumentation_file
+
+# Per-batch timing and resource records of the detection pipeline.
+# Every stage adds its monotonic time (time.perf_counter) to the record of the current batch.
+# Stages may run in several threads (the parser, the concurrent detectors), so a stage time is
+# the sum over its threads, and a nested stage (e.g. annoy_build in ann_scores) is also counted
+# in its parent. At the end of every batch the record is appended as a JSON line to
+# instrumentation_file; nothing is measured when it is None.
+
+# Peak resident memory in MB since the last reset (VmHWM on Linux, the current RSS elsewhere)
+def peak_rss_mb(process):
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return process.memory_info().rss / (1024 * 1024)
+
+# Reset the peak resident memory, so every batch reports its own peak (Linux only)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+class PipelineRecorder():
+    def __init__(self, path=instrumentation_file) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.process = psutil.Process(os.getpid())
+        self.batch = 0
+        self.stages = {}
+        self.counts = {}
+        self.values = {}
+
+    # Add the time of one call of a stage (calls are counted, e.g. the records parsed)
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    # Context manager timing a stage
+    def stage(self, name):
+        if self.path is None:
+            return nullcontext()
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    # Time spent producing the records of an iterator (e.g. parsing) as a stage
+    def timed_iterator(self, records, name):
+        if self.path is None:
+            return records
+        return self.timed_records(records, name)
+
+    def timed_records(self, records, name):
+        iterator = iter(records)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    record = next(iterator)
+                except StopIteration:
+                    return
+                self.add(name, time.perf_counter() - start)
+                yield record
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    # Append the record of the finished batch and start a new one
+    def emit(self, flows, cycle_seconds, batch_seconds):
+        if self.path is None:
+            return
+        with self.lock:
+            record = {
+                'batch': self.batch,
+                'time': time.time(),
+                'flows': flows,
+                'flows_per_second': flows / cycle_seconds if cycle_seconds else None,
+                'cycle_ms': cycle_seconds * 1000 if cycle_seconds is not None else None,
+                'batch_ms': batch_seconds * 1000,
+                **self.values,
+                'rss_mb': self.process.memory_info().rss / (1024 * 1024),
+                'peak_rss_mb': peak_rss_mb(self.process),
+                'stages_ms': {stage: seconds * 1000 for stage, seconds in self.stages.items()},
+                'counts': self.counts,
+            }
+            self.batch += 1
+            self.stages, self.counts, self.values = {}, {}, {}
+            reset_peak_rss()
+
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+recorder = PipelineRecorder()
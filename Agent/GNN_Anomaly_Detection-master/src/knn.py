@@ -0,0 +1,47 @@
+import numpy as np
+
+from config import exact_knn_block_bytes
+
+# Exact k nearest neighbors by blocked matrix multiplies: ||a||^2 + ||b||^2 - 2ab.
+# Only `block` rows of the distance matrix are alive at a time, so memory stays bounded
+# by exact_knn_block_bytes regardless of the number of vectors.
+def exact_knn(vectors, num_neighbors, exclude_self=False, block_bytes=exact_knn_block_bytes):
+    vectors = np.asarray(vectors, dtype=np.float64)
+    n = vectors.shape[0]
+    k = min(num_neighbors, n - 1 if exclude_self else n)
+
+    distances = np.empty((n, k))
+    indices = np.empty((n, k), dtype=np.int64)
+    if k <= 0:
+        return distances, indices
+
+    squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+    block = max(1, block_bytes // (n * vectors.itemsize))
+
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        rows = np.arange(stop - start)
+
+        # Computed in place to keep a single (block, n) buffer alive
+        squared_distances = vectors[start:stop] @ vectors.T
+        squared_distances *= -2
+        squared_distances += squared_norms[start:stop, None]
+        squared_distances += squared_norms[None, :]
+        np.maximum(squared_distances, 0, out=squared_distances)
+        # The distance of a vector to itself is exactly 0 (avoid cancellation errors)
+        squared_distances[rows, start + rows] = np.inf if exclude_self else 0
+
+        # Select the k smallest distances of every row, then sort only them
+        nearest = np.argpartition(squared_distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(squared_distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1)
+
+        indices[start:stop] = np.take_along_axis(nearest, order, axis=1)
+        distances[start:stop] = np.sqrt(np.take_along_axis(nearest_distances, order, axis=1))
+
+    return distances, indices
+
+# Function to calculate the anomaly score (mean distance to the nearest neighbors, the vector itself included) with exact kNN
+def exact_anomaly_scores(embeddings, num_neighbors):
+    distances, _ = exact_knn(embeddings, num_neighbors)
+    return np.mean(distances, axis=1)
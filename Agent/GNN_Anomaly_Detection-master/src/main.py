@@ -28,8 +28,9 @@ if __name__ == '__main__':
     # Get current process
     process = psutil.Process(os.getpid())
 
-    # Start time
-    start_time = time.time()
+    # Start time (monotonic) and CPU time
+    start_time = time.perf_counter()
+    start_cpu = process.cpu_times()
 
     if dataset_type == 'packets_csv':
         separate_packets_csv(input_file_path, num_of_rows=-1, algo='clustering', plot=False, num_of_flows=num_of_flows)
@@ -41,13 +42,15 @@ if __name__ == '__main__':
         process_flows(feature_to_name, input_file_path, num_of_flows, num_of_rows=-1, algo='combined', plot=False)
         
     # End time
-    end_time = time.time()
+    end_time = time.perf_counter()
+    end_cpu = process.cpu_times()
 
     # Processing time
     processing_time = end_time - start_time
 
     # CPU and memory usage
-    cpu_usage = process.cpu_percent(interval=1)  # % over 1 sec
+    # % of one core over the run (user + system time of the process), without sampling after the work is done
+    cpu_usage = 100 * ((end_cpu.user - start_cpu.user) + (end_cpu.system - start_cpu.system)) / processing_time
     memory_usage = process.memory_info().rss / (1024 * 1024)  # in MB
 
     print(f"Processing Time: {processing_time:.2f} seconds")
@@ -1,66 +1,108 @@
 import numpy as np
-from annoy import AnnoyIndex
+import hnswlib
+from collections import deque
 
-from config import network_threshold
+from knn import exact_knn
+from config import network_threshold, network_window_size, network_baseline_size, hnsw_m, hnsw_ef_construction, hnsw_ef
 
 BASE_LINE_AMOUNT = 100
 
+# Running mean/std (Welford) over a sliding window of values
+class RunningStats():
+    def __init__(self, size) -> None:
+        self.values = deque()
+        self.size = size
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        if len(self.values) == self.size:
+            self.remove(self.values.popleft())
+        self.values.append(value)
+        delta = value - self.mean
+        self.mean += delta / len(self.values)
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if len(self.values) == 0:
+            self.mean, self.m2 = 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / len(self.values)
+        self.m2 -= delta * (value - self.mean)
+
+    def std(self):
+        if len(self.values) == 0:
+            return 0.0
+        return np.sqrt(max(self.m2, 0.0) / len(self.values))
+
 class ANN():
     def __init__(self) -> None:
         self.index = None
-    
+
     def create_index(self, dim):
-        # Create an Annoy index
-        dimension = dim  # Number of features in the vectors
-        self.index = AnnoyIndex(dimension, 'euclidean')
-        self.vectors = []
-
-        # Build the index
-        self.index.build(10)  # 10 trees
-        self.num_neighbors = 4  # Number of neighbors to find
+        # Create an incremental HNSW index holding the last network_window_size vectors,
+        # the oldest vector is replaced when the window is full
+        self.index = hnswlib.Index(space='l2', dim=dim)
+        self.index.init_index(max_elements=network_window_size, ef_construction=hnsw_ef_construction, M=hnsw_m, allow_replace_deleted=True)
+        self.index.set_ef(hnsw_ef)
+        self.vectors = deque(maxlen=network_window_size)
+        self.labels = deque()
+
+        self.num_neighbors = 3  # Number of neighbors to find (the vector itself excluded)
         self.number_of_vectors = 0
 
-        self.mean_distances = np.array([])
+        # Mean neighbor distances of the normal vectors (bounded baseline)
+        self.mean_distances = RunningStats(network_baseline_size)
+
+    # Insert a vector into the index, evicting the oldest one when the window is full
+    def insert(self, vector_np):
+        replace_deleted = len(self.labels) == network_window_size
+        if replace_deleted:
+            self.index.mark_deleted(self.labels.popleft())
+        self.index.add_items(vector_np[None, :], [self.number_of_vectors], replace_deleted=replace_deleted)
+        self.labels.append(self.number_of_vectors)
+        self.vectors.append(vector_np)
+        self.number_of_vectors += 1
 
-    # Add a new vector to the annoy index
+    # Mean distance of a vector to its nearest neighbors in the window
+    def mean_distance(self, vector_np):
+        k = min(self.num_neighbors, len(self.labels))
+        distances = self.index.knn_query(vector_np[None, :], k=k)[1][0]
+        # hnswlib returns squared euclidean distances
+        return np.mean(np.sqrt(distances))
+
+    # Add a new vector to the index
     def add_vector(self, vector):
-        means_packet_length = [vector.fwd_packets_length/vector.fwd_packets_amount, 
-                 vector.bwd_packets_length/vector.bwd_packets_amount]
+        means_packet_length = [vector.fwd_packets_length/max(vector.fwd_packets_amount, 1),
+                 vector.bwd_packets_length/max(vector.bwd_packets_amount, 1)]
         flags = list(vector.flags.values())
         attribute_values = flags + list(vector.__dict__.values())[8:] + means_packet_length
-        vector_np = np.array(attribute_values)
-        
+        vector_np = np.array(attribute_values, dtype=np.float32)
+
         if self.index is None:
             self.create_index(len(vector_np))
-        self.index.add_item(self.number_of_vectors, vector_np)
-        self.vectors.append(vector_np)
-        self.number_of_vectors += 1
 
         # Not calculating anomaly score for the first n vectors
-        if self.number_of_vectors < BASE_LINE_AMOUNT:
+        if self.number_of_vectors < BASE_LINE_AMOUNT - 1:
+            self.insert(vector_np)
             return 'base-line'
 
         # Calculate distances for the first n vectors
-        if self.number_of_vectors == BASE_LINE_AMOUNT:
-            # Calculate distances to the nearest neighbors
-            distances = [self.index.get_nns_by_item(i, self.num_neighbors, include_distances=True, search_k=-1)[1][1:] 
-                            for i in range(BASE_LINE_AMOUNT)]
-
-            # Calculate anomaly scores
-            self.mean_distances = np.mean(distances, axis=1)
-                
+        if self.number_of_vectors == BASE_LINE_AMOUNT - 1:
+            self.insert(vector_np)
+            distances, _ = exact_knn(np.array(self.vectors), self.num_neighbors, exclude_self=True)
+            for mean_distance in np.mean(distances, axis=1):
+                self.mean_distances.add(mean_distance)
             return 'base-line'
-        
-        # Calculate anomaly scores
-        curr_vector_distances = self.index.get_nns_by_item(self.number_of_vectors-1, self.num_neighbors, include_distances=True, search_k=-1)[1]
-        curr_vector_distances = curr_vector_distances[1:]
-        curr_vector_mean_distance = np.mean(curr_vector_distances)
-        all_vectors_means = np.mean(self.mean_distances)
-        all_vectors_std = np.std(self.mean_distances)
+
+        # Calculate anomaly score against the window before inserting the vector
+        curr_vector_mean_distance = self.mean_distance(vector_np)
+        self.insert(vector_np)
 
         # Thresholding
-        if curr_vector_mean_distance > all_vectors_means + network_threshold * all_vectors_std:
+        if curr_vector_mean_distance > self.mean_distances.mean + network_threshold * self.mean_distances.std():
             return 'anomaly', curr_vector_mean_distance
         else:
-            self.mean_distances = np.append(self.mean_distances, curr_vector_mean_distance)
+            self.mean_distances.add(curr_vector_mean_distance)
             return 'normal', curr_vector_mean_distance
@@ -3,18 +3,16 @@ import time
 from tri_graph import TriGraph
 from network import ANN
 from results import measure_results
+from alerts import alert_writer
 from execute_pipeline import execute_pipeline
+from ingestion import Pipelined
+from scheduler import DetectionScheduler
+from instrumentation import recorder
+from config import detection_time_window
 
-def process_real_time_flows(dic_feature_to_name, index_name, num_of_flows=1000, poll_interval=5, algo='clustering', plot=False):
-    if algo not in ['ann', 'clustering', 'combined']:
-        print("No valid algorithm specified.")
-        return
-
+# Producer stage: poll Elasticsearch and yield the new flows of every poll (at most F flows per poll)
+def poll_flows(dic_feature_to_name, index_name, batch_size, poll_interval=5):
     es = Elasticsearch("http://localhost:9200")  
-    tri_graph = TriGraph()
-    pred = []
-    label = []
-    node_to_index = {}
 
     last_timestamp = 0  
     eof_detected = False  # Flag to track termination signal
@@ -35,7 +33,7 @@ def process_real_time_flows(dic_feature_to_name, index_name, num_of_flows=1000,
                 }
             },
             "sort": [{"Timestamp": "asc"}],  
-            "size": num_of_flows  
+            "size": batch_size.num_of_flows  
         }
 
         response = es.search(index=index_name, body=query)
@@ -47,25 +45,51 @@ def process_real_time_flows(dic_feature_to_name, index_name, num_of_flows=1000,
                 break  
             else:
                 print("No new flows detected. Waiting...")
+                # An empty poll still lets the consumer check the time trigger
+                yield []
                 time.sleep(poll_interval)
                 continue  
 
         print(f"Processing {len(hits)} new flows...")
 
-        for hit in hits:
-            row = hit["_source"]
-
-            if row[dic_feature_to_name['Protocol']] != dic_feature_to_name['TCP']:
-                continue  
-
-            tri_graph.add_flow_to_graph(row, pred, label, node_to_index, dic_feature_to_name)
-
-        last_timestamp = hits[-1]["_source"]["Timestamp"]
+        rows = [hit["_source"] for hit in hits]
+        last_timestamp = rows[-1]["Timestamp"]
 
-        execute_pipeline(tri_graph, algo, plot, pred, node_to_index)
+        yield [row for row in rows if row[dic_feature_to_name['Protocol']] == dic_feature_to_name['TCP']]
 
         print("Waiting for new flows...")
 
         time.sleep(poll_interval)
 
-    measure_results(tri_graph.graph)
\ No newline at end of file
+def process_real_time_flows(dic_feature_to_name, index_name, num_of_flows=1000, poll_interval=5, algo='clustering', plot=False):
+    if algo not in ['ann', 'clustering', 'combined']:
+        print("No valid algorithm specified.")
+        return
+
+    tri_graph = TriGraph()
+    pred = []
+    label = []
+    node_to_index = {}
+    # Without a time window every poll is analyzed as soon as it arrives
+    scheduler = DetectionScheduler(num_of_flows, clock='wall', time_window=0 if detection_time_window is None else detection_time_window)
+
+    # Consumer stage: the next poll runs while a batch is analyzed, the polls received
+    # meanwhile are coalesced into the next batch
+    flows = Pipelined(recorder.timed_iterator(poll_flows(dic_feature_to_name, index_name, scheduler.batch_size, poll_interval), 'poll'), chunk_size=1)
+    for rows in flows:
+        for row in rows:
+            with recorder.stage('graph_update'):
+                tri_graph.add_flow_to_graph(row, pred, label, node_to_index, dic_feature_to_name)
+            scheduler.add_flow()
+            # F flows trigger a batch also in the middle of a poll (the rest of the poll is still pending)
+            if scheduler.due(pending=1):
+                scheduler.detect(execute_pipeline, tri_graph, algo, plot, pred, node_to_index)
+
+        if scheduler.due(flows.pending()):
+            scheduler.detect(execute_pipeline, tri_graph, algo, plot, pred, node_to_index)
+
+    if scheduler.flows:
+        scheduler.detect(execute_pipeline, tri_graph, algo, plot, pred, node_to_index)
+
+    alert_writer.flush()
+    measure_results(tri_graph.graph, tri_graph.evaluator)
@@ -1,36 +1,58 @@
+import numpy as np
 from sklearn.metrics import (
-    accuracy_score, classification_report, confusion_matrix, roc_curve, roc_auc_score
+    accuracy_score, classification_report, roc_curve, roc_auc_score, average_precision_score
 )
 
-def measure_results(graph):
-    # Extracting the 'pred' and 'label' attributes
-    pred = [data['pred'] for _, data in graph.nodes(data=True)]
-    label = [data['label'] for _, data in graph.nodes(data=True)]
+# FPR levels at which the ROC curve is reported
+ROC_FPR_LEVELS = [0.001, 0.01, 0.05, 0.1, 0.2]
+
+def measure_results(graph, evaluator=None):
+    # The streaming evaluator already holds the predictions, labels and continuous scores of every node
+    if evaluator is not None and len(evaluator.labels) == graph.number_of_nodes():
+        pred, label = evaluator.pred, evaluator.labels
+        tn, fp, fn, tp = evaluator.tn, evaluator.fp, evaluator.fn, evaluator.tp
+        scores = evaluator.scores()
+    else:
+        # Extracting the 'pred' and 'label' attributes
+        pred = np.array([data['pred'] for _, data in graph.nodes(data=True)], dtype=bool)
+        label = np.array([data['label'] for _, data in graph.nodes(data=True)], dtype=bool)
+        tp, fp = int(np.sum(pred & label)), int(np.sum(pred & ~label))
+        fn, tn = int(np.sum(~pred & label)), int(np.sum(~pred & ~label))
+        scores = pred.astype(float)
 
     # Calculate accuracy
     accuracy = accuracy_score(label, pred)
     print(f"Accuracy: {accuracy:.2f}")
     print(classification_report(label, pred))
 
-    # Confusion matrix to compute TPR and FPR
-    tn, fp, fn, tp = confusion_matrix(label, pred).ravel()
+    # Confusion counts to compute TPR and FPR
     tpr = tp / (tp + fn)  # True Positive Rate (Recall)
     fpr = fp / (fp + tn)  # False Positive Rate
-    
+
     print(f"True Positive Rate (TPR): {tpr:.4f}")
     print(f"False Positive Rate (FPR): {fpr:.4f}")
-    
-    # AUROC calculation
+
+    if evaluator is not None and evaluator.latencies:
+        batches, seconds = np.mean(evaluator.latencies, axis=0)
+        print(f"Mean Detection Latency: {batches:.2f} batches ({seconds:.2f} seconds) over {len(evaluator.latencies)} detected attack nodes")
+
+    # AUROC calculation from the continuous scores
     # Ensure binary classification where label and pred are in {0, 1}
     if len(set(label)) == 2:  # Check if binary classification
-        auroc = roc_auc_score(label, pred)
+        auroc = roc_auc_score(label, scores)
         print(f"Area Under the ROC Curve (AUROC): {auroc:.4f}")
-        
-        # Optional: ROC Curve points
-        fpr_values, tpr_values, thresholds = roc_curve(label, pred)
+        print(f"Average Precision (area under the PR curve): {average_precision_score(label, scores):.4f}")
+
+        # ROC Curve points at fixed FPR levels (the scores are relative to the detector thresholds)
+        fpr_values, tpr_values, thresholds = roc_curve(label, scores)
+        # Last point at or below every level, without sklearn's (0, 0) point (infinite threshold) and repeats
+        points = []
+        for level in ROC_FPR_LEVELS:
+            i = np.searchsorted(fpr_values, level, side='right') - 1
+            if i >= 1 and i not in points:
+                points.append(i)
         print("ROC Curve Points:")
-        for i, (f, t) in enumerate(zip(fpr_values, tpr_values)):
-            print(f"Threshold {thresholds[i]:.2f}: FPR = {f:.4f}, TPR = {t:.4f}")
+        for i in points:
+            print(f"Threshold {thresholds[i]:.2f}: FPR = {fpr_values[i]:.4f}, TPR = {tpr_values[i]:.4f}")
     else:
         print("AUROC calculation is only valid for binary classification.")
-
@@ -0,0 +1,149 @@
+import time
+from datetime import datetime
+from functools import lru_cache
+
+from instrumentation import recorder
+from alerts import alert_writer
+
+from config import adaptive_batch_size, detection_latency_target, detection_max_cpu_share, detection_time_window
+from config import adaptive_min_flows, adaptive_max_flows, adaptive_smoothing
+
+# Number of flows per batch (F). With adaptive_batch_size, F follows the measured traffic rate
+# and batch time: it is the largest F whose flows still get a verdict within the latency target
+# (waiting for the batch to fill + analyzing it), but never so small that the detection takes
+# more than its CPU share of the time between batches. The traffic rate is measured with the
+# scheduler's clock (the flow timestamps when replaying files), the batch time is wall-clock time.
+class BatchSize():
+    def __init__(self, num_of_flows) -> None:
+        self.num_of_flows = num_of_flows
+        self.flow_rate = None # flows per second (moving average)
+        self.batch_seconds = None # time to analyze a batch (moving average)
+
+    def average(self, previous, value):
+        if previous is None:
+            return value
+        return adaptive_smoothing * previous + (1 - adaptive_smoothing) * value
+
+    # Largest F within the latency target, at least the F that keeps the CPU share
+    def target_flows(self):
+        latency_flows = self.flow_rate * (detection_latency_target - self.batch_seconds)
+        cpu_flows = self.flow_rate * self.batch_seconds / detection_max_cpu_share
+        return max(latency_flows, cpu_flows)
+
+    # Adapt F to a batch of `flows` new flows that took `batch_seconds` to analyze and
+    # `cycle_seconds` since the previous batch ended, F moves by at most a factor of 2 per batch.
+    # The rate is not measured when the cycle has no duration (unknown or coarse timestamps).
+    def update(self, flows, cycle_seconds, batch_seconds):
+        if not adaptive_batch_size or flows == 0:
+            return
+        if cycle_seconds:
+            self.flow_rate = self.average(self.flow_rate, flows / cycle_seconds)
+        self.batch_seconds = self.average(self.batch_seconds, batch_seconds)
+        if self.flow_rate is None:
+            return
+
+        num_of_flows = min(max(self.target_flows(), self.num_of_flows / 2), self.num_of_flows * 2)
+        self.num_of_flows = int(min(max(num_of_flows, adaptive_min_flows), adaptive_max_flows))
+
+    # Run the detection of a batch, adapt F to its timing and record it. `cycle` returns the time
+    # since the previous batch ended once the batch is done (None when it is not known).
+    def detect(self, flows, cycle, pipeline, *args):
+        start = time.perf_counter()
+        result = pipeline(*args)
+        batch_seconds = time.perf_counter() - start
+        cycle_seconds = cycle()
+        self.update(flows, cycle_seconds, batch_seconds)
+        # The alerts of the batch are counted in its own record
+        with recorder.stage('alerts'):
+            alert_writer.end_batch()
+        recorder.emit(flows, cycle_seconds, batch_seconds)
+        return result
+
+# Timestamp formats of the flow datasets (CIC-IDS-2017, CSE-CIC-IDS-2018, IoT)
+TIMESTAMP_FORMATS = ['%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %I:%M:%S %p', '%d/%m/%Y %I:%M %p', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+
+# Seconds since the epoch of a flow timestamp, None when it cannot be parsed
+@lru_cache(maxsize=1024)
+def parse_timestamp(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    value = str(value).strip()
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, timestamp_format).timestamp()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+# Decides when execute_pipeline runs: after F new flows or T seconds (detection_time_window)
+# since the oldest flow not analyzed yet, whichever comes first. The clock is the traffic time
+# (flow timestamps) when replaying files and the wall-clock time in live modes.
+# Triggers are coalesced: the time window restarts with the first flow after a batch, so a
+# long batch or a gap in the traffic never causes a burst of catch-up batches, and in live
+# mode the flows received while the previous batch ran are absorbed before the next one.
+class DetectionScheduler():
+    def __init__(self, num_of_flows, clock='traffic', time_window=detection_time_window) -> None:
+        self.batch_size = BatchSize(num_of_flows)
+        self.clock = clock
+        self.time_window = time_window
+        self.flows = 0 # flows added since the last batch
+        self.window_start = None # time of the oldest flow not analyzed yet
+        self.cycle_start = None # end of the previous batch, the first flow before the first batch
+        self.latest = None # latest time seen, the flows of a file are not always in time order
+        self.now = None
+
+    def current_time(self, timestamp=None):
+        if self.clock == 'wall':
+            return time.monotonic()
+        return timestamp if timestamp is not None else self.now
+
+    # Window of the time trigger, with adaptive F it also shrinks to what the latency target leaves
+    def window(self):
+        if self.time_window is None or not adaptive_batch_size or self.batch_size.batch_seconds is None:
+            return self.time_window
+        return min(self.time_window, max(detection_latency_target - self.batch_size.batch_seconds, 0))
+
+    def add_flow(self, timestamp=None):
+        self.now = self.current_time(timestamp)
+        if self.window_start is None:
+            self.window_start = self.now
+        if self.now is not None:
+            self.latest = self.now if self.latest is None else max(self.latest, self.now)
+        if self.cycle_start is None:
+            self.cycle_start = self.latest
+        self.flows += 1
+
+    # Whether a batch should run now, `pending` is the number of chunks still waiting in the ingestion queue.
+    # F flows always trigger a batch, in live mode the time trigger waits until the queued flows are applied.
+    def due(self, pending=0):
+        if self.flows == 0:
+            return False
+        if self.flows >= self.batch_size.num_of_flows:
+            return True
+        if self.clock == 'wall' and pending:
+            return False
+        window = self.window()
+        if window is None or self.window_start is None:
+            return False
+        now = self.current_time()
+        return now is not None and now - self.window_start >= window
+
+    # Time since the previous batch ended, the batch is done (None without flow timestamps)
+    def cycle(self):
+        end = time.monotonic() if self.clock == 'wall' else self.latest
+        if end is None or self.cycle_start is None:
+            return None
+        cycle_seconds, self.cycle_start = end - self.cycle_start, end
+        return cycle_seconds
+
+    # Run the detection on the flows added since the last batch
+    def detect(self, pipeline, *args):
+        result = self.batch_size.detect(self.flows, self.cycle, pipeline, *args)
+        self.flows = 0
+        self.window_start = None
+        return result
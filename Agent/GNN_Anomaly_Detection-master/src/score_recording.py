@@ -0,0 +1,40 @@
+import os
+import threading
+import numpy as np
+
+from config import score_recording_dir
+
+# Raw statistics the detectors threshold on, recorded per batch for threshold_sweep.py.
+# The thresholds never feed back into the graph, the embeddings or these statistics, so the
+# verdicts of any other thresholds can be computed from them offline. Every batch is saved as
+# batch_<k>.npz in score_recording_dir (nothing is recorded when it is None):
+#   labels                                          label of every node
+#   ann_scores, ann_mean, ann_std                   ANN mean neighbor distance of every node and their mean/std
+#   history_mean, history_std, history_full         score history of every node before this batch
+#   cluster_labels                                  cluster of every node
+#   cluster_amount, cluster_density, cluster_distances   statistic of every cluster in label order (the isolated nodes first when there are any)
+class ScoreRecorder():
+    def __init__(self, path=score_recording_dir) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.batch = 0
+        self.arrays = {}
+
+    def set(self, name, value):
+        if self.path is None:
+            return
+        with self.lock:
+            self.arrays[name] = np.asarray(value)
+
+    # Save the statistics of the finished batch and start a new one
+    def emit(self, labels):
+        if self.path is None:
+            return
+        with self.lock:
+            arrays, self.arrays = self.arrays, {}
+            batch = self.batch
+            self.batch += 1
+        os.makedirs(self.path, exist_ok=True)
+        np.savez(os.path.join(self.path, f'batch_{batch:05d}.npz'), labels=labels, **arrays)
+
+score_recorder = ScoreRecorder()
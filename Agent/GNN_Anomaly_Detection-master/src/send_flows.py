@@ -0,0 +1,43 @@
+import sys
+import csv
+import json
+import socket
+import urllib.request
+
+from config import service_address
+
+# Send the flows of a CSV file to a running service.py, `chunk_size` records per request.
+# Only the standard library is imported, so a sensor does not pay the start-up of the models.
+def send_flows(input_file_path, address=service_address, chunk_size=1000):
+    with open(input_file_path, mode='r') as file:
+        rows = list(csv.DictReader(file))
+
+    result = {'accepted': 0, 'rejected': 0}
+    host, _, port = address.rpartition(':')
+    if port.isdecimal():
+        for i in range(0, len(rows), chunk_size):
+            request = urllib.request.Request(f'http://{host or "localhost"}:{port}/flows', data=json.dumps(rows[i:i + chunk_size]).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request) as response:
+                for key, value in json.load(response).items():
+                    result[key] += value
+        return result
+
+    # Unix socket: JSON lines on one connection, the reply comes after our side is shut down
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as unix_socket:
+        unix_socket.connect(address)
+        for i in range(0, len(rows), chunk_size):
+            unix_socket.sendall(''.join(json.dumps(row) + '\n' for row in rows[i:i + chunk_size]).encode())
+        unix_socket.shutdown(socket.SHUT_WR)
+        reply = b''
+        while data := unix_socket.recv(1 << 16):
+            reply += data
+    return json.loads(reply)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('usage: send_flows.py input_file_path [address]')
+        exit(1)
+
+    print(send_flows(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else service_address))
@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import signal
+import threading
+from queue import Queue, Empty
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingUnixStreamServer, BaseRequestHandler
+
+from tri_graph import TriGraph
+from alerts import alert_writer
+from execute_pipeline import execute_pipeline
+from ingestion import put
+from scheduler import DetectionScheduler
+from instrumentation import recorder
+from config import feature_to_name, dataset_type, detection_time_window, ingestion_chunk_size
+from config import service_address, service_queue_size, service_poll_interval
+
+# Long-running detector: the models are loaded once and the tri-graph stays warm while sensors
+# send flow records (the CSV columns of feature_to_name as a JSON object) over a local socket:
+#   Unix socket path   one JSON record (or array of records) per line, the reply is
+#                      {"accepted": n, "rejected": m} after the sender shuts down its side
+#   host:port          HTTP, POST /flows with a JSON array or JSON lines, GET /stats
+# Only the detection thread applies the records to the graph. The batches are scheduled like
+# the live Elasticsearch mode (F flows or detection_time_window seconds of wall-clock time, the
+# requests received while a batch runs are coalesced into the next one) and the alerts go to
+# the configured alert sink.
+
+# Fields of a record, by how TriGraph.add_flow_to_graph reads them
+KEY_FIELDS = ['Source IP', 'Source Port', 'Destination IP', 'Destination Port', 'Timestamp', 'Protocol']
+INTEGER_FIELDS = ['amount_Fwd', 'amount_Bwd', 'FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG']
+FLOAT_FIELDS = ['length_Fwd', 'length_Bwd', 'min_packet_length_Fwd', 'min_packet_length_Bwd', 'max_packet_length_Fwd', 'max_packet_length_Bwd']
+
+# Whether a record can be applied to the graph, a bad record must not stop the service
+def valid_flow(row, dic_feature_to_name):
+    if not isinstance(row, dict):
+        return False
+    try:
+        for field in KEY_FIELDS:
+            row[dic_feature_to_name[field]]
+        for field in INTEGER_FIELDS:
+            int(row[dic_feature_to_name[field]])
+        for field in FLOAT_FIELDS:
+            float(row[dic_feature_to_name[field]])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+# Records of JSON lines (a line may hold an array of records), None for a malformed line
+def parse_lines(lines):
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            records.append(None)
+            continue
+        records.extend(record if isinstance(record, list) else [record])
+    return records
+
+# Records of an HTTP body: one JSON document (an array of records or a record, may be pretty-printed)
+# or JSON lines
+def parse_body(body):
+    try:
+        record = json.loads(body)
+    except ValueError:
+        return parse_lines(body.splitlines())
+    return record if isinstance(record, list) else [record]
+
+class FlowService():
+    def __init__(self, num_of_flows, dic_feature_to_name=feature_to_name, algo='combined', queue_size=service_queue_size) -> None:
+        self.dic_feature_to_name = dic_feature_to_name
+        self.algo = algo
+        self.buffer = Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.tri_graph = TriGraph()
+        self.pred = []
+        self.label = []
+        self.node_to_index = {}
+        # Without a time window every request is analyzed as soon as the previous batch is done
+        self.scheduler = DetectionScheduler(num_of_flows, clock='wall', time_window=0 if detection_time_window is None else detection_time_window)
+        self.counts = {'received': 0, 'accepted': 0, 'rejected': 0, 'batches': 0, 'nodes': 0}
+
+    # Server threads: queue the valid TCP records of a request, waits while the queue is full
+    def ingest(self, records):
+        rows = []
+        rejected = 0
+        for row in records:
+            if not valid_flow(row, self.dic_feature_to_name):
+                rejected += 1
+                continue
+            if str(row[self.dic_feature_to_name['Protocol']]) != self.dic_feature_to_name['TCP']:
+                continue
+            # Records of unlabeled traffic count as benign
+            if dataset_type in ['labeled_data', 'elastic_flows']:
+                row.setdefault(self.dic_feature_to_name['Label'], None)
+            rows.append(row)
+
+        if rows and not put(self.buffer, rows, self.stopped):
+            rejected, rows = rejected + len(rows), []
+        with self.lock:
+            self.counts['received'] += len(records)
+            self.counts['accepted'] += len(rows)
+            self.counts['rejected'] += rejected
+        return {'accepted': len(rows), 'rejected': rejected}
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['pending'] = self.buffer.qsize()
+        stats['num_of_flows'] = self.scheduler.batch_size.num_of_flows
+        return stats
+
+    def add_flows(self, rows):
+        for row in rows:
+            with recorder.stage('graph_update'):
+                self.tri_graph.add_flow_to_graph(row, self.pred, self.label, self.node_to_index, self.dic_feature_to_name)
+            self.scheduler.add_flow()
+
+    def detect(self):
+        self.scheduler.detect(execute_pipeline, self.tri_graph, self.algo, False, self.pred, self.node_to_index)
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['nodes'] = self.tri_graph.graph.number_of_nodes()
+
+    # Detection thread: apply the received flows to the warm graph and analyze them until stop(),
+    # then analyze what was still queued
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.add_flows(self.buffer.get(timeout=service_poll_interval))
+            except Empty:
+                pass
+            if self.scheduler.due(self.buffer.qsize()):
+                self.detect()
+
+        while True:
+            try:
+                self.add_flows(self.buffer.get_nowait())
+            except Empty:
+                break
+        if self.scheduler.flows:
+            self.detect()
+        alert_writer.flush()
+
+    def stop(self):
+        self.stopped.set()
+
+# JSON lines over a Unix socket, the records are queued as they arrive (one queue operation per read)
+class FlowStreamHandler(BaseRequestHandler):
+    def handle(self):
+        result = {'accepted': 0, 'rejected': 0}
+        pending = b''
+        while data := self.request.recv(1 << 16):
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for i in range(0, len(lines), ingestion_chunk_size):
+                for key, value in self.server.service.ingest(parse_lines(lines[i:i + ingestion_chunk_size])).items():
+                    result[key] += value
+        for key, value in self.server.service.ingest(parse_lines([pending])).items():
+            result[key] += value
+        try:
+            self.request.sendall((json.dumps(result) + '\n').encode())
+        except OSError:
+            pass
+
+class FlowHTTPHandler(BaseHTTPRequestHandler):
+    def reply(self, status, body):
+        data = (json.dumps(body) + '\n').encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != '/flows':
+            return self.reply(404, {'error': f'unknown path {self.path}'})
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(200, self.server.service.ingest(parse_body(body)))
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': f'unknown path {self.path}'})
+        self.reply(200, self.server.service.stats())
+
+    # No access log, the alerts may go to stdout
+    def log_message(self, format, *args):
+        pass
+
+# Unix socket server for a path, HTTP server for host:port (like the socket alert sink)
+def create_server(address, service):
+    host, _, port = address.rpartition(':')
+    if port.isdecimal():
+        server = ThreadingHTTPServer((host or 'localhost', int(port)), FlowHTTPHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = ThreadingUnixStreamServer(address, FlowStreamHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+# Run the service until SIGINT/SIGTERM
+def serve(address=service_address, num_of_flows=2000, algo='combined'):
+    service = FlowService(num_of_flows, algo=algo)
+    server = create_server(address, service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_number, lambda *_: service.stop())
+
+    print(f'Listening for flows on {address}...', file=sys.stderr)
+    try:
+        service.run()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server, ThreadingUnixStreamServer):
+            os.remove(address)
+    print(f'Stopped: {json.dumps(service.stats())}', file=sys.stderr)
+
+if __name__ == '__main__':
+
+    # service.py [address] [num_of_flows], send_flows.py feeds it from a CSV file
+    address = sys.argv[1] if len(sys.argv) > 1 else service_address
+    num_of_flows = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdecimal() else 2000
+    serve(address, num_of_flows)
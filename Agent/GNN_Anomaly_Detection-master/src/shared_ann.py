@@ -0,0 +1,71 @@
+import os
+import itertools
+import numpy as np
+from annoy import AnnoyIndex
+from concurrent.futures import ProcessPoolExecutor
+
+from config import ann_shared_index_dir, ann_query_processes
+
+# The per-batch Annoy index is built straight into a file (tmpfs / shared memory, e.g. /dev/shm)
+# and every scoring process mmaps the same file read-only, so the index memory does not grow
+# with the number of scorers.
+
+batch_counter = itertools.count()
+pool = None
+
+# Index loaded by a worker process: (path, index)
+worker_index = (None, None)
+
+# A new file per batch, a file is never rewritten while a worker still maps it
+def shared_index_path():
+    return os.path.join(ann_shared_index_dir, f'ann_index_{os.getpid()}_{next(batch_counter)}.ann')
+
+# Write the neighbors Annoy returned for an item into row i. Annoy can return fewer than asked
+# (small search_k, few trees, duplicate points), the missing entries are -1 with a NaN distance.
+def store_neighbors(neighbors, distances, i, result):
+    row_neighbors, row_distances = result
+    count = len(row_neighbors)
+    neighbors[i, :count], distances[i, :count] = row_neighbors, row_distances
+    neighbors[i, count:], distances[i, count:] = -1, np.nan
+
+# Memory-map a shared index read-only (can be used by any process on the host)
+def load_shared_annoy_index(path, dim):
+    index = AnnoyIndex(dim, 'euclidean')
+    index.load(path, prefault=False)
+    return index
+
+# Query a chunk of items in a worker process, the index is loaded once per batch file
+def query_chunk(path, dim, start, stop, num_neighbors, search_k):
+    global worker_index
+    loaded_path, index = worker_index
+    if loaded_path != path:
+        if index is not None:
+            index.unload()
+        index = load_shared_annoy_index(path, dim)
+        worker_index = (path, index)
+
+    distances = np.empty((stop - start, num_neighbors))
+    neighbors = np.empty((stop - start, num_neighbors), dtype=np.int64)
+    for i in range(start, stop):
+        store_neighbors(neighbors, distances, i - start, index.get_nns_by_item(i, num_neighbors, include_distances=True, search_k=search_k))
+    return start, distances, neighbors
+
+# Fan the neighbor queries of a shared index out to the worker processes
+def query_shared_annoy(path, dim, num_items, num_neighbors, search_k=-1):
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=ann_query_processes)
+
+    num_neighbors = min(num_neighbors, num_items)
+    distances = np.empty((num_items, num_neighbors))
+    neighbors = np.empty((num_items, num_neighbors), dtype=np.int64)
+
+    chunk_size = max(1, -(-num_items // ann_query_processes))
+    futures = [pool.submit(query_chunk, path, dim, start, min(start + chunk_size, num_items), num_neighbors, search_k)
+               for start in range(0, num_items, chunk_size)]
+    for future in futures:
+        start, chunk_distances, chunk_neighbors = future.result()
+        distances[start:start + len(chunk_distances)] = chunk_distances
+        neighbors[start:start + len(chunk_neighbors)] = chunk_neighbors
+
+    return distances, neighbors
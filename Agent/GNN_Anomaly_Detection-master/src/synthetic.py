@@ -0,0 +1,196 @@
+import sys
+import csv
+import heapq
+import random
+import itertools
+from datetime import datetime, timezone
+
+from feature_to_name import feature_to_name_CIC_2017, feature_to_name_IoT, feature_to_name_elastic
+from config import attacker_ip, victom_ip
+
+# Deterministic synthetic traffic for benchmarks: flow CSVs in the CIC-IDS-2017 / IoT / elastic
+# schemas and packet CSVs in the tshark column schema, all derived from the same simulated packets.
+# Benign clients open connections from a pool of sockets to a set of servers (the victim is one of
+# them); the attacker injects DoS, port scan and brute force flows against the victim, every attack
+# in its own part of the timeline.
+
+HOSTS = 200
+SOCKETS_PER_HOST = 20
+SERVERS = 50
+SERVER_PORTS = [80, 443, 443, 443, 22, 25, 8080]
+FLOW_RATE = 100 # flows per second
+UDP_FRACTION = 0.1
+ATTACKS = {'dos': 0.02, 'scan': 0.02, 'bruteforce': 0.01} # share of the flows
+ATTACK_WINDOWS = {'dos': (0.2, 0.4), 'scan': (0.5, 0.6), 'bruteforce': (0.7, 0.9)} # part of the timeline
+START_TIME = 1499335200.0 # 06/07/2017 10:00 UTC
+HEADER_LENGTH = 54
+
+SCHEMAS = {
+    'cic2017': feature_to_name_CIC_2017,
+    'iot': feature_to_name_IoT,
+    'elastic': feature_to_name_elastic,
+}
+
+# Label column, benign and attack label of every schema (CIC-IDS-2017 has the attack name)
+LABELS = {
+    'cic2017': (' Label', 'BENIGN', None),
+    'iot': (feature_to_name_IoT['Label'], '0', feature_to_name_IoT['Attack Label']),
+    'elastic': (feature_to_name_elastic['Label'], 'benign', feature_to_name_elastic['Attack Label']),
+}
+
+PACKET_COLUMNS = ['frame.time_epoch', 'frame.len', 'ip.proto', 'ip.src', 'ip.dst', 'tcp.srcport', 'tcp.dstport', 'tcp.stream',
+                  'tcp.time_delta', 'tcp.flags.fin', 'tcp.flags.syn', 'tcp.flags.reset', 'tcp.flags.push', 'tcp.flags.ack', 'tcp.flags.urg']
+
+FLAGS = ['FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG']
+
+# Packet of a flow: (time offset, forward?, frame length, set of flags)
+def tcp_packets(rng, requests, request_length, response_length, close='FIN'):
+    packets = [(0.0, True, 66, {'SYN'}), (0.001, False, 66, {'SYN', 'ACK'}), (0.002, True, HEADER_LENGTH, {'ACK'})]
+    offset = 0.002
+    for _ in range(requests):
+        offset += rng.expovariate(20)
+        packets.append((offset, True, HEADER_LENGTH + request_length(), {'PSH', 'ACK'}))
+        offset += rng.expovariate(50)
+        packets.append((offset, False, HEADER_LENGTH + response_length(), {'PSH', 'ACK'}))
+    offset += rng.expovariate(20)
+    if close == 'RST':
+        packets.append((offset, False, HEADER_LENGTH, {'RST', 'ACK'}))
+    else:
+        packets += [(offset, True, HEADER_LENGTH, {'FIN', 'ACK'}), (offset + 0.001, False, HEADER_LENGTH, {'FIN', 'ACK'}),
+                    (offset + 0.002, True, HEADER_LENGTH, {'ACK'})]
+    return packets
+
+def benign_flow(rng, hosts, sockets_per_host, servers):
+    host = rng.randrange(hosts)
+    src_ip = f'192.168.{10 + host // 250}.{host % 250 + 1}'
+    src_port = 49152 + (host * 7919 + rng.randrange(sockets_per_host)) % 16384
+    server = rng.randrange(servers)
+    dst_ip = victom_ip if server == 0 else f'52.{server // 250}.{server % 250}.{(server * 37) % 250 + 1}'
+    dst_port = SERVER_PORTS[server % len(SERVER_PORTS)]
+    packets = tcp_packets(rng, rng.randint(1, 6), lambda: int(rng.lognormvariate(5, 1)), lambda: int(rng.lognormvariate(7, 1.2)))
+    return src_ip, src_port, dst_ip, dst_port, packets
+
+def attack_flow(rng, attack):
+    src_port = rng.randrange(32768, 61000)
+    if attack == 'dos':
+        # Slow HTTP: many tiny partial requests on a connection the server finally resets
+        packets = tcp_packets(rng, rng.randint(10, 30), lambda: rng.randint(1, 8), lambda: 0, close='RST')
+        return attacker_ip, src_port, victom_ip, 80, packets
+    if attack == 'scan':
+        # SYN to a random port, answered by a reset
+        return attacker_ip, src_port, victom_ip, rng.randrange(1, 1024), [(0.0, True, 60, {'SYN'}), (0.0005, False, HEADER_LENGTH, {'RST', 'ACK'})]
+    # Brute force: login attempts of almost the same size
+    packets = tcp_packets(rng, rng.randint(3, 5), lambda: rng.randint(90, 110), lambda: rng.randint(60, 70))
+    return attacker_ip, src_port, victom_ip, 22, packets
+
+# Simulated flows in start time order: dicts with the endpoints, protocol, start time, attack and packets
+def generate_flows(num_flows, hosts=HOSTS, sockets_per_host=SOCKETS_PER_HOST, servers=SERVERS, attacks=ATTACKS,
+                   udp_fraction=UDP_FRACTION, flow_rate=FLOW_RATE, seed=0):
+    rng = random.Random(seed)
+    start = START_TIME
+    for i in range(num_flows):
+        start += rng.expovariate(flow_rate)
+        progress = i / num_flows
+
+        attack = None
+        for name, share in attacks.items():
+            window_start, window_end = ATTACK_WINDOWS[name]
+            if window_start <= progress < window_end and rng.random() < share / (window_end - window_start):
+                attack = name
+                break
+
+        if attack is not None:
+            src_ip, src_port, dst_ip, dst_port, packets = attack_flow(rng, attack)
+            protocol = 'tcp'
+        else:
+            src_ip, src_port, dst_ip, dst_port, packets = benign_flow(rng, hosts, sockets_per_host, servers)
+            protocol = 'udp' if rng.random() < udp_fraction else 'tcp'
+            if protocol == 'udp':
+                dst_port = 53
+                packets = [(0.0, True, 80, set()), (0.01, False, 200, set())]
+
+        yield {'stream': i, 'src_ip': src_ip, 'src_port': src_port, 'dst_ip': dst_ip, 'dst_port': dst_port,
+               'protocol': protocol, 'start': start, 'attack': attack, 'packets': packets}
+
+def format_timestamp(timestamp, schema):
+    if schema == 'elastic':
+        return f'{timestamp:.6f}'
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    if schema == 'iot':
+        return moment.strftime('%d/%m/%Y %I:%M:%S %p')
+    return moment.strftime('%d/%m/%Y %H:%M')
+
+# One row of a flow CSV in the given schema
+def flow_row(flow, schema):
+    names = SCHEMAS[schema]
+    row = {}
+    for direction, forward in [('Fwd', True), ('Bwd', False)]:
+        payloads = [max(length - HEADER_LENGTH, 0) for _, fwd, length, _ in flow['packets'] if fwd == forward]
+        row[names[f'amount_{direction}']] = len(payloads)
+        row[names[f'length_{direction}']] = sum(payloads)
+        row[names[f'min_packet_length_{direction}']] = min(payloads, default=0)
+        row[names[f'max_packet_length_{direction}']] = max(payloads, default=0)
+    for flag in FLAGS:
+        row[names[flag]] = sum(flag in flags for _, _, _, flags in flow['packets'])
+
+    row[names['Source IP']], row[names['Source Port']] = flow['src_ip'], flow['src_port']
+    row[names['Destination IP']], row[names['Destination Port']] = flow['dst_ip'], flow['dst_port']
+    row[names['Protocol']] = names['TCP'] if flow['protocol'] == 'tcp' else ('udp' if schema == 'elastic' else '17')
+    row[names['Timestamp']] = format_timestamp(flow['start'], schema)
+
+    label_column, benign_label, attack_label = LABELS[schema]
+    row[label_column] = benign_label if flow['attack'] is None else (attack_label or flow['attack'])
+    return row
+
+def write_flows(path, flows, schema='cic2017'):
+    with open(path, 'w', newline='') as file:
+        writer = None
+        for flow in flows:
+            row = flow_row(flow, schema)
+            if writer is None:
+                writer = csv.DictWriter(file, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+
+# Packets of all the flows in time order, in the tshark CSV columns
+def write_packets(path, flows):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(PACKET_COLUMNS)
+        pending = []
+        order = itertools.count() # ties keep the generation order
+        for flow in flows:
+            # Flows start in time order, the packets before this start can be written
+            while pending and pending[0][0] <= flow['start']:
+                writer.writerow(heapq.heappop(pending)[2])
+
+            previous = 0.0
+            for offset, forward, length, flags in flow['packets']:
+                src, dst = (flow['src_ip'], flow['dst_ip']) if forward else (flow['dst_ip'], flow['src_ip'])
+                if flow['protocol'] == 'udp':
+                    row = [f'{flow["start"] + offset:.6f}', length, 17, src, dst] + [''] * 10
+                else:
+                    src_port, dst_port = (flow['src_port'], flow['dst_port']) if forward else (flow['dst_port'], flow['src_port'])
+                    row = [f'{flow["start"] + offset:.6f}', length, 6, src, dst, src_port, dst_port, flow['stream'], f'{offset - previous:.6f}'] + \
+                          [int(flag in flags) for flag in FLAGS]
+                previous = offset
+                heapq.heappush(pending, (flow['start'] + offset, next(order), row))
+
+        while pending:
+            writer.writerow(heapq.heappop(pending)[2])
+
+# Write a synthetic dataset, `schema` is a flow schema (cic2017, iot, elastic) or 'packets'
+def generate_dataset(path, num_flows, schema='cic2017', **settings):
+    flows = generate_flows(num_flows, **settings)
+    if schema == 'packets':
+        write_packets(path, flows)
+    else:
+        write_flows(path, flows, schema)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3 or not sys.argv[2].isdecimal():
+        print(f'usage: synthetic.py output_path num_of_flows [{"|".join(list(SCHEMAS) + ["packets"])}]')
+        exit(1)
+
+    generate_dataset(sys.argv[1], int(sys.argv[2]), sys.argv[3] if len(sys.argv) > 3 else 'cic2017')
@@ -0,0 +1,122 @@
+import os
+import sys
+import glob
+import numpy as np
+
+from verdicts import relative
+from config import ann_threshold, ann_history_threshold, clustering_threshold
+
+# Evaluate a grid of detector thresholds on the statistics recorded with score_recording_dir,
+# without re-running the pipeline. A node is predicted anomalous once any batch flags it, and a
+# detector flags a node when its statistic exceeds the threshold, so the verdict of a node under
+# threshold t only depends on the highest statistic the node reached over the batches:
+#   ann         (score - batch mean) / batch std
+#   history     (score - history mean) / history std, once the history is full
+#               (with a zero std every score above the mean is flagged, like the pipeline)
+#   clustering  |statistic - mean| / std of the node's cluster, over amount, density and distances
+# The whole grid is then one comparison of these maxima against the thresholds.
+
+ANN_THRESHOLDS = [1, 2, 3, 5, 7, 10, 15, 20, 30]
+HISTORY_THRESHOLDS = [3, 5, 10, 15, 20, 30, 50]
+CLUSTERING_THRESHOLDS = [1, 2, 3, 4, 5, 7, 10]
+
+CLUSTER_STATISTICS = ['cluster_amount', 'cluster_density', 'cluster_distances']
+
+def load_batches(score_dir):
+    paths = sorted(glob.glob(os.path.join(score_dir, 'batch_*.npz')))
+    if not paths:
+        raise FileNotFoundError(f'no recorded batches in {score_dir}')
+    for path in paths:
+        with np.load(path) as batch:
+            yield {name: batch[name] for name in batch.files}
+
+# Deviation of the cluster of every node, like clustering.unusual_clusters (the statistics are in label
+# order, the isolated nodes first when there are any)
+def cluster_node_deviations(labels, elements):
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    first = int(len(unique_labels) > 0 and unique_labels[0] == -1)
+    elements = np.asarray(elements, dtype=np.float64)[first:]
+    deviations = relative(np.abs(elements - np.mean(elements)), 0, np.std(elements)) if len(elements) else elements
+    scored = labels >= 0
+    node_deviations = np.full(len(labels), -np.inf)
+    node_deviations[scored] = deviations[inverse[scored] - first]
+    return node_deviations
+
+# Highest statistic of every node per detector over all the batches, and the labels of the last batch
+def node_maxima(batches):
+    maxima = {}
+    labels = None
+    for batch in batches:
+        labels = batch['labels'].astype(bool)
+        statistics = {}
+        if 'ann_scores' in batch:
+            statistics['ann'] = relative(batch['ann_scores'], batch['ann_mean'], batch['ann_std'])
+        if 'history_mean' in batch:
+            statistics['history'] = relative(batch['ann_scores'], batch['history_mean'], batch['history_std'], batch['history_full'])
+        if 'cluster_labels' in batch:
+            statistics['clustering'] = np.max([cluster_node_deviations(batch['cluster_labels'], batch[name]) for name in CLUSTER_STATISTICS], axis=0)
+
+        for detector, values in statistics.items():
+            previous = maxima.get(detector, np.full(0, -np.inf))
+            # The graph only grows, a batch covers the nodes of the previous ones
+            maxima[detector] = np.maximum(np.concatenate([previous, np.full(len(values) - len(previous), -np.inf)]), values)
+    return maxima, labels
+
+# Confusion counts of every threshold combination, predictions are the OR of the detectors that ran
+def sweep(maxima, labels, ann_thresholds=ANN_THRESHOLDS, history_thresholds=HISTORY_THRESHOLDS, clustering_thresholds=CLUSTERING_THRESHOLDS):
+    num_nodes = len(labels)
+    def flags(detector, thresholds):
+        if detector not in maxima:
+            return np.zeros((1, num_nodes), dtype=bool), [None]
+        values = np.concatenate([maxima[detector], np.full(num_nodes - len(maxima[detector]), -np.inf)])
+        return values[None, :] > np.asarray(thresholds, dtype=np.float64)[:, None], thresholds
+
+    ann_flags, ann_thresholds = flags('ann', ann_thresholds)
+    history_flags, history_thresholds = flags('history', history_thresholds)
+    cluster_flags, clustering_thresholds = flags('clustering', clustering_thresholds)
+
+    results = []
+    positives = int(labels.sum())
+    for j, history_threshold in enumerate(history_thresholds):
+        for k, clustering_threshold in enumerate(clustering_thresholds):
+            # All the ANN thresholds at once: (ANN thresholds x nodes)
+            pred = ann_flags | history_flags[j] | cluster_flags[k]
+            tp = np.count_nonzero(pred & labels, axis=1)
+            fp = np.count_nonzero(pred & ~labels, axis=1)
+            for i, ann_threshold in enumerate(ann_thresholds):
+                results.append({
+                    'ann_threshold': ann_threshold,
+                    'ann_history_threshold': history_threshold,
+                    'clustering_threshold': clustering_threshold,
+                    'tp': int(tp[i]), 'fp': int(fp[i]), 'fn': positives - int(tp[i]), 'tn': num_nodes - positives - int(fp[i]),
+                })
+
+    for result in results:
+        result['tpr'] = result['tp'] / max(result['tp'] + result['fn'], 1)
+        result['fpr'] = result['fp'] / max(result['fp'] + result['tn'], 1)
+        result['precision'] = result['tp'] / max(result['tp'] + result['fp'], 1)
+        result['f1'] = 2 * result['tp'] / max(2 * result['tp'] + result['fp'] + result['fn'], 1)
+    return results
+
+def grid(argument, default):
+    return default if argument is None else [float(value) for value in argument.split(',')]
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('usage: threshold_sweep.py score_dir [ann_thresholds, e.g. 5,10,15] [history_thresholds] [clustering_thresholds]')
+        exit(1)
+
+    arguments = sys.argv[2:] + [None] * (5 - len(sys.argv))
+    maxima, labels = node_maxima(load_batches(sys.argv[1]))
+    results = sweep(maxima, labels, grid(arguments[0], ANN_THRESHOLDS), grid(arguments[1], HISTORY_THRESHOLDS), grid(arguments[2], CLUSTERING_THRESHOLDS))
+
+    print('ann_threshold, ann_history_threshold, clustering_threshold, tp, fp, fn, tn, tpr, fpr, precision, f1')
+    for result in results:
+        print(f'{result["ann_threshold"]}, {result["ann_history_threshold"]}, {result["clustering_threshold"]}, '
+              f'{result["tp"]}, {result["fp"]}, {result["fn"]}, {result["tn"]}, '
+              f'{result["tpr"]:.4f}, {result["fpr"]:.4f}, {result["precision"]:.4f}, {result["f1"]:.4f}')
+
+    best = max(results, key=lambda result: result['f1'])
+    print(f'best f1 {best["f1"]:.4f}: ann_threshold={best["ann_threshold"]}, ann_history_threshold={best["ann_history_threshold"]}, '
+          f'clustering_threshold={best["clustering_threshold"]} (configured: {ann_threshold}, {ann_history_threshold}, {clustering_threshold})')
@@ -11,8 +11,13 @@ class TriGraph():
         self.ip_to_id = {}
         self.graph = nx.Graph()
         self.count_flows = 1
-        # self.ip_to_color = {}
+        self.ip_to_color = {}
         self.gcn_model = None
+        self.ann_index = None
+        self.clusterer = None
+        self.verdicts = None
+        self.evaluator = None
+        self.artifact_cache = None
     
     from graph_embedding import create_embeddings
     from visualization import visualize_directed_graph
@@ -54,7 +59,7 @@ class TriGraph():
                                 min_packet_length = 0, max_packet_length = 0, mean_packet_length = 0,
                                 FIN_count = 0,  SYN_count = 0,  RST_count = 0,  PSH_count = 0,  ACK_count = 0,  
                                 URG_count = 0, count_opened_sockets = 0, 
-                                anomaly_score_history =  [], cluster = -1,
+                                cluster = -1,
                                 pred = False, label = src_label, cluster_pred = False, ann_pred = False,
                                 ip = vector.src, flows = 1, color = src_color, timestamp=vector.timestamp)
                 
@@ -63,7 +68,7 @@ class TriGraph():
                                 min_packet_length = 0, max_packet_length = 0, mean_packet_length = 0,
                                 FIN_count = 0,  SYN_count = 0,  RST_count = 0,  PSH_count = 0,  ACK_count = 0,  
                                 URG_count = 0, count_opened_sockets = 0, 
-                                anomaly_score_history =  [], cluster = -1,
+                                cluster = -1,
                                 pred = False, label = src_label, cluster_pred = False, ann_pred = False,
                                 ip = vector.src, flows = 0, color = src_color, timestamp=vector.timestamp)
 
@@ -72,7 +77,7 @@ class TriGraph():
                                 min_packet_length = 0, max_packet_length = 0, mean_packet_length = 0,
                                 FIN_count = 0,  SYN_count = 0,  RST_count = 0,  PSH_count = 0,  ACK_count = 0,  
                                 URG_count = 0, count_opened_sockets = 0,
-                                anomaly_score_history =  [], cluster = -1,
+                                cluster = -1,
                                 pred = False, label = dst_label, cluster_pred = False, ann_pred = False,
                                 ip = vector.dst, sip = vector.src, flows = 0, color = dst_color, timestamp=vector.timestamp)
         
@@ -147,7 +152,7 @@ class TriGraph():
                                 min_packet_length = 0, max_packet_length = 0, mean_packet_length = 0,
                                 FIN_count = 0,  SYN_count = 0,  RST_count = 0,  PSH_count = 0,  ACK_count = 0,  
                                 URG_count = 0,
-                                anomaly_score_history =  [], cluster = -1, printed = False,
+                                cluster = -1, printed = False,
                                 pred = False, label = src_label, cluster_pred = False, ann_pred = False,
                                 ip = src_ip, port = None, flows = 1, color = src_color)
                 
@@ -159,7 +164,7 @@ class TriGraph():
                                 min_packet_length = 0, max_packet_length = 0, mean_packet_length = 0,
                                 FIN_count = 0,  SYN_count = 0,  RST_count = 0,  PSH_count = 0,  ACK_count = 0,  
                                 URG_count = 0,
-                                anomaly_score_history =  [], cluster = -1, printed = False,
+                                cluster = -1, printed = False,
                                 pred = False, label = src_label, cluster_pred = False, ann_pred = False,
                                 ip = src_ip, port = src_port, flows = 0, color = src_color)
 
@@ -171,7 +176,7 @@ class TriGraph():
                                 min_packet_length = 0, max_packet_length = 0, mean_packet_length = 0,
                                 FIN_count = 0,  SYN_count = 0,  RST_count = 0,  PSH_count = 0,  ACK_count = 0,  
                                 URG_count = 0,
-                                anomaly_score_history =  [], cluster = -1, printed = False,
+                                cluster = -1, printed = False,
                                 pred = False, label = dst_label, cluster_pred = False, ann_pred = False,
                                 ip = dst_ip, port = dst_port, sip = src, flows = 0, color = dst_color)
         
@@ -0,0 +1,85 @@
+import sys
+import json
+import numpy as np
+
+from ann import build_annoy_index, query_annoy, size_bucket, NUM_NEIGHBORS
+from knn import exact_knn
+from benchmark import collect_embeddings, timed
+from config import ann_tuning_file, ann_recall_target
+
+N_TREES_GRID = [1, 2, 5, 10, 20, 50]
+SEARCH_K_GRID = [-1, 100, 500, 2000, 10000]
+
+# Recall@k against exact kNN. Embeddings often repeat, so a returned neighbor counts
+# as correct when it is not farther than the exact k-th neighbor (robust to ties).
+def recall_at_k(distances, exact_distances):
+    kth_distance = exact_distances[:, -1:]
+    tolerance = 1e-6 * max(float(np.max(exact_distances)), 1.0)
+    return float(np.mean(np.minimum(np.sum(distances <= kth_distance + tolerance, axis=1), exact_distances.shape[1]) / exact_distances.shape[1]))
+
+# Measure build time, query time and recall of every grid point on a set of embeddings
+def measure_grid(embeddings, num_neighbors=NUM_NEIGHBORS):
+    exact_distances, _ = exact_knn(embeddings, num_neighbors)
+    results = []
+    for n_trees in N_TREES_GRID:
+        index, build_ms = timed(build_annoy_index, embeddings, n_trees)
+        for search_k in SEARCH_K_GRID:
+            (distances, _), query_ms = timed(query_annoy, index, embeddings.shape[0], num_neighbors, search_k)
+            results.append({
+                'n_trees': n_trees,
+                'search_k': search_k,
+                'build_ms': build_ms,
+                'query_ms': query_ms,
+                'recall': recall_at_k(distances, exact_distances),
+            })
+    return results
+
+# Cheapest configuration (build + query time) that meets the recall target, or the most accurate one
+def choose_parameters(results, recall_target=ann_recall_target):
+    passing = [result for result in results if result['recall'] >= recall_target]
+    if passing:
+        return min(passing, key=lambda result: result['build_ms'] + result['query_ms'])
+    return max(results, key=lambda result: (result['recall'], -(result['build_ms'] + result['query_ms'])))
+
+# Tune the Annoy parameters on the embeddings of a real run, one graph-size bucket at a time
+def tune(input_file_path, num_of_flows, output_file=ann_tuning_file):
+    # Keep the largest batch of every size bucket as its sample
+    samples = {}
+    for _, embeddings in collect_embeddings(input_file_path, num_of_flows):
+        samples[size_bucket(len(embeddings))] = embeddings
+
+    tuning = {}
+    for bucket, embeddings in sorted(samples.items()):
+        results = measure_grid(embeddings)
+        print(f'bucket {bucket} ({len(embeddings)} nodes):')
+        for result in results:
+            print(f'  n_trees={result["n_trees"]}, search_k={result["search_k"]}: build {result["build_ms"]:.1f} ms, '
+                  f'query {result["query_ms"]:.1f} ms, recall@{NUM_NEIGHBORS} {result["recall"]:.4f}')
+
+        chosen = choose_parameters(results)
+        print(f'  chosen: n_trees={chosen["n_trees"]}, search_k={chosen["search_k"]}')
+        tuning[str(bucket)] = chosen
+
+    # Merge with the buckets tuned on other runs
+    try:
+        with open(output_file) as file:
+            tuning = {**json.load(file), **tuning}
+    except FileNotFoundError:
+        pass
+
+    with open(output_file, 'w') as file:
+        json.dump(tuning, file, indent=4, sort_keys=True)
+    print(f'saved tuning of {len(tuning)} buckets to {output_file}')
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print('usage: tune_ann.py input_file_path num_of_flows')
+        exit(1)
+
+    if len(sys.argv) < 3 or not sys.argv[2].isdecimal():
+        num_of_flows = 2000
+    else:
+        num_of_flows = int(sys.argv[2])
+
+    tune(sys.argv[1], num_of_flows)
@@ -0,0 +1,100 @@
+import numpy as np
+
+from score_recording import score_recorder
+from config import anomaly_score_history_size
+
+# (values - mean) / scale, -inf outside `where`. With a zero scale the threshold rule
+# value > mean + threshold * scale flags every value above the mean whatever the threshold,
+# so those values are +inf and the others -inf.
+def relative(values, mean=0.0, scale=1.0, where=True):
+    values = np.asarray(values, dtype=np.float64)
+    scale = np.broadcast_to(scale, values.shape)
+    where = np.broadcast_to(where, values.shape)
+    result = np.where(where & (values > mean), np.inf, -np.inf)
+    np.divide(values - mean, scale, out=result, where=where & (scale > 0))
+    return result
+
+# Detection state of every node in arrays aligned with the graph node order (the embedding rows).
+# Nodes are only ever added to the tri-graph, so the arrays grow at the end with every batch.
+# The detectors update the arrays with whole-batch expressions, and only the nodes whose state
+# changed are written back to the node attributes (read by the results and the plots) and to the
+# prediction list.
+class Verdicts():
+    def __init__(self, history_size=anomaly_score_history_size) -> None:
+        self.history_size = history_size
+        self.pred = np.zeros(0, dtype=bool)
+        self.cluster_pred = np.zeros(0, dtype=bool)
+        self.ann_pred = np.zeros(0, dtype=bool)
+        self.cluster = np.full(0, -1, dtype=np.int64) # last unusual cluster of the node, -1 if none
+        self.label = np.full(0, -1, dtype=np.int64) # HDBSCAN label of the node in the last clustering, -1 for noise
+        self.score = np.full(0, -np.inf) # highest detector statistic relative to its threshold (above 1 is flagged)
+        self.history = np.zeros((0, history_size)) # last ANN scores of every node (ring buffer)
+        self.history_length = np.zeros(0, dtype=np.int64) # scores recorded per node
+
+    # State of a graph that was analyzed without verdict arrays (the score history starts empty)
+    @classmethod
+    def of_graph(cls, graph):
+        verdicts = cls()
+        verdicts.resize(graph.number_of_nodes())
+        for i, (_, node) in enumerate(graph.nodes(data=True)):
+            verdicts.pred[i], verdicts.cluster_pred[i], verdicts.ann_pred[i] = node['pred'], node['cluster_pred'], node['ann_pred']
+            verdicts.cluster[i] = node['cluster']
+        return verdicts
+
+    # Add the nodes that joined the graph since the previous batch
+    def resize(self, num_nodes):
+        added = num_nodes - len(self.pred)
+        if added <= 0:
+            return
+        self.pred = np.concatenate([self.pred, np.zeros(added, dtype=bool)])
+        self.cluster_pred = np.concatenate([self.cluster_pred, np.zeros(added, dtype=bool)])
+        self.ann_pred = np.concatenate([self.ann_pred, np.zeros(added, dtype=bool)])
+        self.cluster = np.concatenate([self.cluster, np.full(added, -1, dtype=np.int64)])
+        self.label = np.concatenate([self.label, np.full(added, -1, dtype=np.int64)])
+        self.score = np.concatenate([self.score, np.full(added, -np.inf)])
+        self.history = np.concatenate([self.history, np.zeros((added, self.history_size))])
+        self.history_length = np.concatenate([self.history_length, np.zeros(added, dtype=np.int64)])
+
+    def snapshot(self):
+        return self.pred.copy(), self.cluster_pred.copy(), self.ann_pred.copy(), self.cluster.copy()
+
+    # Nodes whose verdicts differ from the snapshot
+    def changed(self, snapshot):
+        pred, cluster_pred, ann_pred, cluster = snapshot
+        return np.flatnonzero((self.pred != pred) | (self.cluster_pred != cluster_pred) | (self.ann_pred != ann_pred) | (self.cluster != cluster))
+
+    # Write the verdicts of the nodes changed since the snapshot to the graph and the prediction list
+    def write_back(self, graph, snapshot, pred, node_to_index, list_nodes=None):
+        list_nodes = list(graph.nodes) if list_nodes is None else list_nodes
+        for i in self.changed(snapshot):
+            node = graph.nodes[list_nodes[i]]
+            node['pred'] = bool(self.pred[i])
+            node['cluster_pred'] = bool(self.cluster_pred[i])
+            node['ann_pred'] = bool(self.ann_pred[i])
+            node['cluster'] = int(self.cluster[i])
+            if self.cluster_pred[i]:
+                node['color'] = "lightgreen" if node['label'] else "yellow"
+            if list_nodes[i] in node_to_index:
+                pred[node_to_index[list_nodes[i]]] = node['pred']
+
+    # Keep the highest relative score (values - mean) / scale of every node, the nodes outside `where` keep their score
+    def raise_score(self, values, mean=0.0, scale=1.0, where=True):
+        self.score[:len(values)] = np.maximum(self.score[:len(values)], relative(values, mean, scale, where))
+
+    # Combined rule: an ANN verdict counts when the node is in an unusual cluster or is an HDBSCAN noise point
+    def confirmed(self, flagged):
+        return flagged & (self.cluster_pred | (self.label == -1))
+
+    # Add the ANN scores of the batch to the history, returns the nodes whose score exceeds their
+    # full history by more than `threshold` standard deviations
+    def add_scores(self, scores, threshold):
+        full = self.history_length >= self.history_size
+        mean, std = self.history.mean(axis=1), self.history.std(axis=1)
+        score_recorder.set('history_mean', mean)
+        score_recorder.set('history_std', std)
+        score_recorder.set('history_full', full)
+        flagged = full & (scores > mean + threshold * std)
+        self.raise_score(scores, mean, threshold * std, full)
+        self.history[np.arange(len(scores)), self.history_length % self.history_size] = scores
+        self.history_length += 1
+        return flagged
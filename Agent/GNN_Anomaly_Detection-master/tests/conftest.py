@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src/ import each other by name, like when main.py runs from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
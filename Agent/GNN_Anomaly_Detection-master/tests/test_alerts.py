@@ -0,0 +1,40 @@
+import gc
+import networkx as nx
+
+from alerts import AlertWriter
+
+def graph_with_nodes(count):
+    graph = nx.Graph()
+    for i in range(count):
+        graph.add_node(f'{i}ip', side='Server', ip='10.0.0.1', port=str(80 + i), flows=1, label=False)
+    return graph
+
+# Repeats are suppressed within the window, then the node is forgotten and alerted again
+def test_reported_nodes_are_evicted_after_the_window():
+    writer = AlertWriter(kind=None, suppression_window=2)
+    graph = graph_with_nodes(3)
+    def batch():
+        for node_id in graph.nodes:
+            writer.emit(graph, node_id, 'ann', 'ann')
+        writer.end_batch()
+
+    batch()
+    assert {node_id: reported[0] for node_id, reported in writer.reported[graph].items()} == {'0ip': 0, '1ip': 0, '2ip': 0}
+    # A suppressed repeat does not renew the alert, it leaves the window after the batch
+    batch()
+    assert graph not in writer.reported
+    batch()
+    assert {node_id: reported[0] for node_id, reported in writer.reported[graph].items()} == {'0ip': 2, '1ip': 2, '2ip': 2}
+
+# The state of a graph does not outlive it
+def test_state_is_dropped_with_the_graph():
+    writer = AlertWriter(kind=None, suppression_window=100)
+    graph = graph_with_nodes(2)
+    writer.emit(graph, '0ip', 'ann', 'ann')
+    writer.end_batch()
+    writer.emit(graph, '1ip', 'clustering', 'amount')
+    assert len(writer.reported) == 1 and len(writer.verdicts) == 1
+
+    del graph
+    gc.collect()
+    assert len(writer.reported) == 0 and len(writer.verdicts) == 0
@@ -0,0 +1,15 @@
+import numpy as np
+
+from ann import query_annoy
+
+# Annoy returns fewer neighbors than asked with a small search_k, few trees or duplicate points
+class ShortIndex():
+    def get_nns_by_item(self, i, num_neighbors, include_distances, search_k):
+        count = num_neighbors if i % 2 == 0 else 2
+        return list(range(count)), [float(j) for j in range(count)]
+
+def test_short_annoy_results_are_padded():
+    distances, neighbors = query_annoy(ShortIndex(), 4, 4)
+    np.testing.assert_array_equal(neighbors[1], [0, 1, -1, -1])
+    np.testing.assert_array_equal(np.isnan(distances[1]), [False, False, True, True])
+    np.testing.assert_array_equal(np.nanmean(distances, axis=1), [1.5, 0.5, 1.5, 0.5])
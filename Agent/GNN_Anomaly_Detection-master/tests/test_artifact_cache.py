@@ -0,0 +1,46 @@
+import networkx as nx
+import numpy as np
+
+import artifact_cache
+from artifact_cache import open_artifact_cache
+from tri_graph import TriGraph
+
+def graph_of(count_flows):
+    tri_graph = TriGraph()
+    tri_graph.graph = nx.path_graph(3)
+    tri_graph.count_flows = count_flows
+    return tri_graph
+
+def test_each_run_opens_its_own_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_cache, 'artifact_cache_dir', None)
+    first, second = tmp_path / 'first.csv', tmp_path / 'second.csv'
+    first.write_text('a\n1\n')
+    second.write_text('a\n2\n')
+    assert open_artifact_cache(str(first), reader='flows') is None
+
+    monkeypatch.setattr(artifact_cache, 'artifact_cache_dir', str(tmp_path / 'cache'))
+    assert open_artifact_cache(str(tmp_path / 'missing.csv'), reader='flows') is None
+    cache = open_artifact_cache(str(first), reader='flows')
+    other = open_artifact_cache(str(second), reader='flows')
+    tri_graph = graph_of(10)
+    assert cache.key(tri_graph, 'embeddings') != other.key(tri_graph, 'embeddings')
+
+    # A new run on the same input finds the artifacts of the previous one
+    cache.store(cache.key(tri_graph, 'embeddings'), 'embeddings', np.arange(6.0).reshape(3, 2))
+    again = open_artifact_cache(str(first), reader='flows')
+    assert np.array_equal(again.load(again.key(tri_graph, 'embeddings'), 'embeddings'), np.arange(6.0).reshape(3, 2))
+    assert again.load(again.key(graph_of(11), 'embeddings'), 'embeddings') is None
+
+def test_key_covers_the_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_cache, 'artifact_cache_dir', str(tmp_path / 'cache'))
+    (tmp_path / 'input.csv').write_text('a\n1\n')
+    cache = open_artifact_cache(str(tmp_path / 'input.csv'), reader='flows')
+    tri_graph = graph_of(10)
+    embeddings, clusters = cache.key(tri_graph, 'embeddings'), cache.key(tri_graph, 'clusters')
+
+    monkeypatch.setitem(artifact_cache.CLUSTERING_SETTINGS, 'clustering_leaf_size', 7)
+    assert cache.key(tri_graph, 'embeddings') == embeddings
+    assert cache.key(tri_graph, 'clusters') != clusters
+
+    monkeypatch.setitem(artifact_cache.EMBEDDING_SETTINGS, 'attacker_ip', '10.0.0.1')
+    assert cache.key(tri_graph, 'embeddings') != embeddings
@@ -0,0 +1,38 @@
+import numpy as np
+
+from clustering import OnlineClusterer, clustering_algorithm, detect_cluster_anomalies, flagged_nodes
+from threshold_sweep import cluster_node_deviations
+
+# A graph too small to hold a cluster is all noise, like in the full mode, until it grows
+def test_online_clustering_of_a_tiny_graph():
+    rng = np.random.default_rng(0)
+    clusterer = OnlineClusterer()
+    embeddings = rng.normal(size=(3, 8))
+
+    labels = clusterer.labels_of(embeddings)
+    np.testing.assert_array_equal(labels, clustering_algorithm(embeddings))
+    np.testing.assert_array_equal(labels, [-1, -1, -1])
+
+    # Two well separated groups once there are enough nodes
+    embeddings = np.concatenate([embeddings, rng.normal(size=(20, 8)), rng.normal(loc=20, size=(20, 8))])
+    labels = clusterer.labels_of(embeddings)
+    assert len(labels) == len(embeddings)
+    assert len(set(labels[3:23])) == 1 and len(set(labels[23:])) == 1 and labels[3] != labels[23]
+
+# The statistics are indexed by group, which is the label shifted by one only when there are noise points
+def test_unusual_cluster_with_and_without_noise():
+    rng = np.random.default_rng(0)
+    sizes = [100] + [5] * 30
+    clusters = np.repeat(np.arange(len(sizes)), sizes)
+    embeddings = rng.normal(size=(len(clusters), 4)) + 10 * clusters[:, None]
+    big = np.flatnonzero(clusters == 0)
+    for labels in [clusters, np.concatenate([clusters, [-1, -1]])]:
+        vectors = np.concatenate([embeddings, rng.normal(size=(len(labels) - len(clusters), 4))])
+        np.testing.assert_array_equal(flagged_nodes(vectors, labels), big)
+
+        _, unusual = detect_cluster_anomalies(vectors, labels)
+        description, unusual_elements, deviations = unusual[0]
+        assert description == 'amount' and [cluster for cluster, _ in unusual_elements] == [0]
+        node_deviations = cluster_node_deviations(labels, np.unique(labels, return_counts=True)[1])
+        np.testing.assert_allclose(node_deviations[big], deviations[0])
+        assert np.all(node_deviations[labels == -1] == -np.inf)
@@ -0,0 +1,22 @@
+import numpy as np
+
+from hnsw_index import HNSWIndex
+
+# Scores of an index updated over several batches must match an index built from the last batch
+def test_incremental_scores_match_fresh_index():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(400, 8)).astype(np.float32)
+    index = HNSWIndex(8)
+    index.anomaly_scores_of(embeddings)
+
+    for _ in range(3):
+        # Move some rows and add new rows next to existing ones, so they enter the neighborhood of old rows
+        embeddings = embeddings.copy()
+        moved = rng.choice(len(embeddings), 40, replace=False)
+        embeddings[moved] = rng.normal(size=(40, 8))
+        near = embeddings[rng.choice(len(embeddings), 60)] + rng.normal(scale=0.01, size=(60, 8))
+        embeddings = np.concatenate([embeddings, near.astype(np.float32)])
+
+        scores = index.anomaly_scores_of(embeddings)
+        expected = HNSWIndex(8).anomaly_scores_of(embeddings)
+        np.testing.assert_allclose(scores, expected, rtol=1e-5)
@@ -0,0 +1,37 @@
+import pytest
+
+import scheduler
+from scheduler import DetectionScheduler
+
+def add_flows(scheduler, count):
+    for _ in range(count):
+        scheduler.add_flow()
+
+# In live mode queued input only delays the time trigger, F flows always trigger a batch
+def test_flow_trigger_fires_with_queued_input():
+    scheduler = DetectionScheduler(10, clock='wall', time_window=0)
+    add_flows(scheduler, 9)
+    assert not scheduler.due(pending=3)
+    assert scheduler.due(pending=0)
+
+    add_flows(scheduler, 1)
+    assert scheduler.due(pending=3)
+
+    scheduler.detect(lambda: None)
+    assert scheduler.flows == 0
+    assert not scheduler.due(pending=3)
+
+# When replaying a file the traffic rate comes from the flow timestamps, not from the parser's throughput
+def test_replay_measures_the_traffic_rate(monkeypatch):
+    monkeypatch.setattr(scheduler, 'adaptive_batch_size', True)
+    detection = DetectionScheduler(100, time_window=None)
+    for i in range(100):
+        detection.add_flow(1000 + i / 10)
+    detection.detect(lambda: None)
+    # The first cycle starts with the first flow
+    assert detection.batch_size.flow_rate == pytest.approx(100 / 9.9)
+
+    for i in range(50):
+        detection.add_flow(1009.9 + (i + 1) / 5)
+    detection.detect(lambda: None)
+    assert detection.batch_size.flow_rate == pytest.approx(scheduler.adaptive_smoothing * 100 / 9.9 + (1 - scheduler.adaptive_smoothing) * 5)
@@ -0,0 +1,16 @@
+import json
+
+from service import parse_body
+
+RECORDS = [{'Source IP': '10.0.0.1', 'Destination Port': 80}, {'Source IP': '10.0.0.2', 'Destination Port': 443}]
+
+# A pretty-printed array is one document, not one record per line
+def test_parse_a_json_document():
+    assert parse_body(json.dumps(RECORDS, indent=2).encode()) == RECORDS
+    assert parse_body(json.dumps(RECORDS[0], indent=2).encode()) == RECORDS[:1]
+
+def test_parse_json_lines():
+    body = '\n'.join(json.dumps(record) for record in RECORDS).encode()
+    assert parse_body(body) == RECORDS
+    # A malformed line is rejected, the others are kept
+    assert parse_body(body + b'\n{"Source IP": \n' + json.dumps(RECORDS).encode()) == RECORDS + [None] + RECORDS
@@ -0,0 +1,31 @@
+import numpy as np
+
+from verdicts import Verdicts
+from threshold_sweep import node_maxima, sweep
+
+# A node above a constant (zero std) score history is flagged by the pipeline whatever the
+# threshold, the sweep must give the same verdicts
+def test_sweep_flags_scores_above_a_constant_history():
+    verdicts = Verdicts(history_size=3)
+    verdicts.resize(3)
+    for _ in range(3):
+        verdicts.add_scores(np.array([1.0, 1.0, 2.0]), threshold=20)
+
+    scores = np.array([1.0, 1.5, 2.0])
+    full = verdicts.history_length >= verdicts.history_size
+    batch = {
+        'labels': np.array([0, 1, 0]),
+        'ann_scores': scores,
+        'ann_mean': scores.mean(),
+        'ann_std': scores.std(),
+        'history_mean': verdicts.history.mean(axis=1),
+        'history_std': verdicts.history.std(axis=1),
+        'history_full': full,
+    }
+    flagged = verdicts.add_scores(scores, threshold=20)
+    np.testing.assert_array_equal(flagged, [False, True, False])
+    assert verdicts.score[1] == np.inf
+
+    maxima, labels = node_maxima([batch])
+    for result in sweep(maxima, labels, ann_thresholds=[100], history_thresholds=[3, 20, 50]):
+        assert (result['tp'], result['fp']) == (1, 0)
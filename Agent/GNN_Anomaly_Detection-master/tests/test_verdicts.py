@@ -0,0 +1,34 @@
+import networkx as nx
+import numpy as np
+
+import ann
+from ann import ann_algorithm
+from clustering import check_all_anomalies
+from verdicts import Verdicts
+
+def graph_with_nodes(count):
+    graph = nx.Graph()
+    for i in range(count):
+        graph.add_node(f'{i}ip', pred=False, cluster_pred=False, ann_pred=False, cluster=-1, label=False)
+    return graph
+
+# In combined mode an ANN verdict counts only in an unusual cluster or on an HDBSCAN noise point
+def test_combined_rule_ignores_ann_verdicts_in_ordinary_clusters(monkeypatch):
+    monkeypatch.setattr(ann, 'ann_threshold', 1)
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(10, 4))
+    embeddings = np.concatenate([points, points + 50, [[25, 25, 25, 25]]])
+    clusters = np.array([0] * 10 + [1] * 10 + [-1])
+    graph = graph_with_nodes(len(clusters))
+    verdicts = Verdicts()
+    verdicts.resize(len(clusters))
+
+    check_all_anomalies(graph, embeddings, clusters, [], {}, False, verdicts=verdicts)
+    assert not verdicts.cluster_pred.any()
+
+    scores = np.ones(len(clusters))
+    scores[[0, 20]] = 10
+    ann_algorithm(graph, embeddings, False, 'combined', anomaly_scores=scores, verdicts=verdicts)
+    np.testing.assert_array_equal(np.flatnonzero(verdicts.ann_pred), [0, 20])
+    np.testing.assert_array_equal(np.flatnonzero(verdicts.pred), [20])
+    assert not graph.nodes['0ip']['pred'] and graph.nodes['20ip']['pred']
@@ -205,9 +205,44 @@ def download_pdf():
     return send_file(buffer, mimetype="application/pdf", as_attachment=True, download_name="report.pdf")
 
 
+# One alert record of the detector (a JSON line, see alerts.ALERT_FIELDS) as the anomaly text of the prompts
+def format_alert(record: dict) -> str:
+    port = record.get("port")
+    anomaly_id = f"{record.get('ip')}:{port}" if port is not None else str(record.get("ip"))
+    scores = ", ".join(f"{reason}: {score:.2f}" for reason, score in (record.get("scores") or {}).items())
+    return "\n".join([
+        f"found ({', '.join(record.get('reasons', []))}) anomaly in node: {record.get('node')}",
+        f"Anomaly ID: {anomaly_id}",
+        f"Side: {record.get('side')}",
+        f"Detectors: {', '.join(record.get('detectors', []))}",
+        f"Scores: {scores or 'none'}",
+        f"Cluster: {record.get('cluster')}",
+        f"Flows: {record.get('flows')}",
+        f"Detection batch: {record.get('batch')}",
+        f"Repeats suppressed since the previous alert: {record.get('suppressed', 0)}",
+    ])
+
+
 def split_anomalies(raw_text: str) -> list[tuple[str, list[str]]]:
-    pattern = re.compile(r"(found(?: \([^)]+\))? anomaly in node: ({.*?}))", re.DOTALL)
     results = {}
+
+    # Alert records, one JSON object per line
+    for line in raw_text.splitlines():
+        line = line.strip()
+        if not line.startswith("{"):
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(record, dict) or "node" not in record or "reasons" not in record:
+            continue
+        cluster = record.get("cluster")
+        cluster_id = str(cluster) if cluster is not None else "unknown"
+        results.setdefault(cluster_id, []).append(format_alert(record))
+
+    # Outputs of older versions: "found (<reason>) anomaly in node: {...}"
+    pattern = re.compile(r"(found(?: \([^)]+\))? anomaly in node: ({.*?}))", re.DOTALL)
     for match in pattern.finditer(raw_text):
         full_text = match.group(1).strip()
         import ast
@@ -243,12 +278,13 @@ Respond in this exact format:
 🧪 **Impact Summary**:
 - Describe affected systems, risks, goals
 
-📊 **Key Metrics**:
-- Packet Lengths: avg/max
-- Packet Count: total
+📊 **Key Metrics** (only the values present in the log):
+- Flows: total
+- Detectors and scores: e.g. ann / clustering (amount, density, distances)
+- Packet Lengths: avg/max, if present
 - Source IPs: [list]
 - Affected Ports: [list]
-- Flags: e.g. PSH/ACK/URG
+- Flags: e.g. PSH/ACK/URG, if present
 
 🔍 **Supporting Evidence**:
 - Unusual timing, repeated flags, etc.